@@ -5,23 +5,42 @@ GPS位置管理系统
 轻量化单体应用架构
 """
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, flash
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, session, flash, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import sqlite3
 import json
 import math
 import gzip
+import zlib
 import base64
+import binascii
 import os
 import smtplib
-from email.mime.text import MimeText
-from email.mime.multipart import MimeMultipart
+import hashlib
+import hmac
+import sys
+import glob
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
 import shutil
 import redis
+import queue
+import threading
+import time
+import atexit
+import fcntl
+import heapq
+import itertools
+from array import array
+from collections import namedtuple, OrderedDict, deque
 from functools import wraps
 import logging
+from sqlalchemy import event, create_engine, inspect
+from sqlalchemy.orm import object_session
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -29,12 +48,103 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'gps-system-secret-key-2025'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///gps_system.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///gps_system.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# GPS写入模式：sync 请求内直接提交；async 入队后由后台线程合并提交
+app.config['GPS_INGEST_MODE'] = os.environ.get('GPS_INGEST_MODE', 'sync')
+app.config['INGEST_QUEUE_SIZE'] = int(os.environ.get('INGEST_QUEUE_SIZE', 5000))
+app.config['INGEST_BATCH_POINTS'] = int(os.environ.get('INGEST_BATCH_POINTS', 2000))
+app.config['INGEST_MAX_WAIT'] = float(os.environ.get('INGEST_MAX_WAIT', 0.2))
+
+# 最新位置缓存：进程内缓存的容量与有效期（秒，仅无Redis时生效）
+app.config['LATEST_CACHE_SIZE'] = int(os.environ.get('LATEST_CACHE_SIZE', 20000))
+app.config['LATEST_CACHE_TTL'] = float(os.environ.get('LATEST_CACHE_TTL', 5))
+
+# 轨迹归档：每个压缩段覆盖的时间窗口（秒）
+app.config['TRACK_SEGMENT_SECONDS'] = int(os.environ.get('TRACK_SEGMENT_SECONDS', 3600))
+
+# 电子围栏：空间网格边长（度）与全量重载间隔（秒，用于同步其他进程的修改）
+app.config['GEOFENCE_CELL_SIZE'] = float(os.environ.get('GEOFENCE_CELL_SIZE', 0.05))
+app.config['GEOFENCE_RELOAD_SECONDS'] = int(os.environ.get('GEOFENCE_RELOAD_SECONDS', 300))
+
+# 存储监控：采样间隔与告警冷却时间（秒）
+app.config['STORAGE_CHECK_INTERVAL'] = int(os.environ.get('STORAGE_CHECK_INTERVAL', 60))
+app.config['STORAGE_ALERT_COOLDOWN'] = int(os.environ.get('STORAGE_ALERT_COOLDOWN', 6 * 3600))
+
+# 系统配置缓存检查版本号的间隔（秒），即其他进程修改配置后生效的最大延迟
+app.config['CONFIG_CHECK_INTERVAL'] = float(os.environ.get('CONFIG_CHECK_INTERVAL', 2))
+
+# 管理后台统计快照的重算间隔（秒）
+app.config['DASHBOARD_STATS_TTL'] = float(os.environ.get('DASHBOARD_STATS_TTL', 10))
+
+# 设备注册表：状态写回间隔与全量重载间隔（秒）
+app.config['DEVICE_FLUSH_INTERVAL'] = float(os.environ.get('DEVICE_FLUSH_INTERVAL', 5))
+app.config['DEVICE_RELOAD_INTERVAL'] = float(os.environ.get('DEVICE_RELOAD_INTERVAL', 60))
+
+# 附近车辆查询：最新位置空间网格边长（度）与全量重建间隔（秒，用于同步其他进程的位置）
+app.config['POSITION_INDEX_CELL_SIZE'] = float(os.environ.get('POSITION_INDEX_CELL_SIZE', 0.02))
+app.config['POSITION_INDEX_RELOAD_SECONDS'] = int(os.environ.get('POSITION_INDEX_RELOAD_SECONDS', 60))
+
+# 每个工作进程的处理线程数，须与 gunicorn --threads 一致
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 8))
+
+# 实时推送：每个客户端的缓冲条数与每个工作进程的最大连接数
+# gthread 模式下每个推送连接在打开期间一直占用一个线程，默认最多占四分之一，上限为一半，其余留给上传和管理请求
+app.config['STREAM_BUFFER_SIZE'] = int(os.environ.get('STREAM_BUFFER_SIZE', 500))
+app.config['STREAM_MAX_CLIENTS'] = int(os.environ.get('STREAM_MAX_CLIENTS', max(1, app.config['WEB_THREADS'] // 4)))
+if app.config['STREAM_MAX_CLIENTS'] > max(1, app.config['WEB_THREADS'] // 2):
+    app.config['STREAM_MAX_CLIENTS'] = max(1, app.config['WEB_THREADS'] // 2)
+    logger.warning(f"STREAM_MAX_CLIENTS 超过处理线程数的一半，已限制为 {app.config['STREAM_MAX_CLIENTS']}")
+
+# 在线状态检查间隔（秒），离线超时时间见系统配置 device_offline_timeout
+app.config['PRESENCE_CHECK_INTERVAL'] = float(os.environ.get('PRESENCE_CHECK_INTERVAL', 5))
+
+# 位置数据分片：按 device_id 哈希拆分到N个SQLite文件（1 表示不分片，仍写主库）
+# 分片数决定设备到文件的映射，上线后修改需先迁移数据
+app.config['LOCATION_SHARDS'] = int(os.environ.get('LOCATION_SHARDS', 1))
+app.config['LOCATION_SHARD_DIR'] = os.environ.get('LOCATION_SHARD_DIR', app.instance_path)
+
+# 监控指标：各工作进程写快照的共享目录与间隔（秒），/metrics 的访问令牌（为空则不校验）
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+
+# 慢请求采样分析：超过该耗时（毫秒）的请求记录调用栈采样，0 表示关闭；采样间隔（秒）
+app.config['SLOW_REQUEST_PROFILE_MS'] = float(os.environ.get('SLOW_REQUEST_PROFILE_MS', 0))
+app.config['PROFILE_SAMPLE_INTERVAL'] = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# 数据保留：原始轨迹、1分钟降采样、10分钟降采样各保留的天数（10分钟一级为0表示永久保留）
+app.config['RETENTION_RAW_DAYS'] = float(os.environ.get('RETENTION_RAW_DAYS', 7))
+app.config['RETENTION_1M_DAYS'] = float(os.environ.get('RETENTION_1M_DAYS', 90))
+app.config['RETENTION_10M_DAYS'] = float(os.environ.get('RETENTION_10M_DAYS', 365))
+# 压缩任务间隔、实时位置表裁剪间隔（秒），每个事务处理的记录数与事务间的停顿（秒）
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('RETENTION_INTERVAL', 600))
+app.config['RETENTION_TRIM_INTERVAL'] = float(os.environ.get('RETENTION_TRIM_INTERVAL', 30))
+app.config['RETENTION_BATCH_SIZE'] = int(os.environ.get('RETENTION_BATCH_SIZE', 50))
+app.config['RETENTION_BATCH_PAUSE'] = float(os.environ.get('RETENTION_BATCH_PAUSE', 0.05))
+
+# 软件授权清单的签名密钥（HMAC-SHA256），必须通过环境变量单独设置；未设置时拒绝下发清单
+app.config['MANIFEST_SIGNING_KEY'] = os.environ.get('MANIFEST_SIGNING_KEY', '')
+if not app.config['MANIFEST_SIGNING_KEY']:
+    logger.warning("未设置 MANIFEST_SIGNING_KEY：软件授权清单无法签名，车机获取清单将返回503")
+
 # 数据库初始化
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLite连接调优：WAL模式允许读写并发，降低同步级别减少fsync"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA cache_size=-8000')  # 8MB页缓存
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 # Redis连接（如果可用）
 try:
     redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
@@ -44,6 +154,397 @@ except:
     REDIS_AVAILABLE = False
     logger.warning("Redis不可用，使用内存缓存")
 
+# ==================== 监控指标 ====================
+
+# 指标类型与说明；未登记的指标不会输出
+METRIC_DEFINITIONS = {
+    'gps_http_requests_total': ('counter', 'HTTP请求数'),
+    'gps_http_request_duration_seconds': ('histogram', 'HTTP请求耗时（流式响应只计到首字节）'),
+    'gps_sql_statements_total': ('counter', 'SQL语句数，后台线程的语句记在 endpoint="background"'),
+    'gps_sql_seconds_total': ('counter', 'SQL执行耗时'),
+    'gps_sql_statements_per_request': ('histogram', '每个请求执行的SQL语句数'),
+    'gps_ingest_points_total': ('counter', 'GPS点数：received 收到、invalid 格式无效、rejected 队列满拒绝、debounced 防抖丢弃、stored 入库、failed 写入出错丢弃'),
+    'gps_ingest_queue_depth': ('gauge', '异步写入队列中的上传数'),
+    'gps_redis_checks_total': ('counter', 'Redis可用性检查次数'),
+    'gps_redis_up': ('gauge', '最近一次Redis检查是否成功'),
+    'gps_slow_requests_total': ('counter', '被采样分析的慢请求数'),
+    'gps_retention_rows_total': ('counter', '数据保留任务处理的记录数：trimmed 裁剪实时位置、rolled_up 降采样、purged 过期删除'),
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{k}="' + v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+class MetricsRegistry:
+    """进程内指标，定期把快照写到共享目录，抓取时合并所有工作进程
+
+    计数器与直方图累加全部快照：已退出进程的快照并入 metrics_retired.json 后删除，保证单调递增；
+    仪表只取存活进程，按登记时指定的方式（求和或取最大值）合并
+    """
+    
+    RETIRED_FILE = 'metrics_retired.json'
+    
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}  # (name, labels) -> 值
+        self._histograms = {}  # (name, labels) -> [各桶计数, 总和, 次数, 桶边界]
+        self._gauges = {}  # name -> (回调，返回 {labels: 值}, 合并函数)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._started_at = time.time()
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0, buckets]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+    
+    def gauge(self, name, callback, aggregate=sum):
+        """登记仪表：callback 返回 {标签元组: 值}，在快照时调用；aggregate 合并各进程的值，
+        数量类用 sum，状态类（如是否可用）用 max"""
+        self._gauges[name] = (callback, aggregate)
+    
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, list(labels), list(h[0]), h[1], h[2], list(h[3])] for (name, labels), h in self._histograms.items()]
+        gauges = []
+        for name, (callback, _) in self._gauges.items():
+            try:
+                for labels, value in callback().items():
+                    gauges.append([name, list(labels), value])
+            except Exception as e:
+                logger.warning(f"采集指标 {name} 失败: {e}")
+        return {
+            'pid': os.getpid(), 'started_at': self._started_at, 'written_at': time.time(),
+            'counters': counters, 'histograms': histograms, 'gauges': gauges
+        }
+    
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics_{pid}.json')
+    
+    def flush(self):
+        """写入本进程快照（先写临时文件再替换，读取方不会读到半个文件）"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(os.getpid())
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning(f"写入指标快照失败: {e}")
+    
+    @staticmethod
+    def _merge(snapshots):
+        """累加快照中的计数器和直方图，仪表按 (名称, 标签) 收集各进程的值"""
+        counters, histograms, gauges = {}, {}, {}
+        for data in snapshots:
+            for name, labels, value in data['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total, count, buckets in data['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                if merged is None or merged[3] != buckets:
+                    merged = histograms[key] = [[0] * len(buckets), 0.0, 0, buckets]
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+            for name, labels, value in data.get('gauges', []):
+                gauges.setdefault((name, tuple(map(tuple, labels))), []).append(value)
+        return counters, histograms, gauges
+    
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _retire(self, snapshots):
+        """已退出进程（或同一pid的上一个进程）的计数器和直方图并入 metrics_retired.json，
+        之后删除其快照文件；调用方需持有目录锁"""
+        retired_path = os.path.join(self.directory, self.RETIRED_FILE)
+        retired = self._read(retired_path) or {'counters': [], 'histograms': []}
+        counters, histograms, _ = self._merge([retired] + [data for _, data in snapshots])
+        retired = {
+            'pid': None,
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), h[0], h[1], h[2], list(h[3])] for (name, labels), h in histograms.items()],
+        }
+        with open(retired_path + '.tmp', 'w') as f:
+            json.dump(retired, f)
+        os.replace(retired_path + '.tmp', retired_path)
+        for path, _ in snapshots:
+            os.remove(path)
+        logger.info(f"已合并 {len(snapshots)} 个已退出进程的指标快照")
+    
+    def _load_snapshots(self):
+        """读取其他进程与已退出进程的快照；在目录锁内先把已退出进程的快照并入汇总文件"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'metrics.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            live, stale = [], []
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+                if os.path.basename(path) == self.RETIRED_FILE:
+                    continue
+                data = self._read(path)
+                if data is None:
+                    continue
+                if data['pid'] == os.getpid():
+                    # pid 被复用：文件属于之前的同号进程
+                    if data.get('started_at') != self._started_at:
+                        stale.append((path, data))
+                    continue
+                if _process_alive(data['pid']):
+                    live.append(data)
+                else:
+                    stale.append((path, data))
+            if stale:
+                self._retire(stale)
+            retired = self._read(os.path.join(self.directory, self.RETIRED_FILE))
+        return live + ([retired] if retired else [])
+    
+    def collect(self):
+        """合并所有工作进程的快照，本进程用实时数据"""
+        snapshots = [self.snapshot()]
+        try:
+            snapshots.extend(self._load_snapshots())
+        except OSError as e:
+            logger.warning(f"读取指标快照失败: {e}")
+        
+        counters, histograms, values = self._merge(snapshots)
+        gauges = {}
+        for (name, labels), items in values.items():
+            aggregate = self._gauges[name][1] if name in self._gauges else sum
+            gauges[(name, labels)] = aggregate(items)
+        return counters, histograms, gauges
+    
+    def render(self):
+        """Prometheus 文本格式"""
+        counters, histograms, gauges = self.collect()
+        series = {}
+        for (name, labels), value in sorted(counters.items()) + sorted(gauges.items()):
+            series.setdefault(name, []).append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", repr(float(bound))),))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        
+        output = []
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            if name not in series:
+                continue
+            output.append(f'# HELP {name} {help_text}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(series[name])
+        return '\n'.join(output) + '\n'
+    
+    def start(self):
+        """启动定期写快照的线程（每个工作进程一个）"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._started_at = time.time()
+        try:
+            # 写第一个快照前先处理同pid旧进程留下的文件，避免被覆盖后计数器倒退
+            self._load_snapshots()
+        except OSError as e:
+            logger.warning(f"整理指标快照失败: {e}")
+        threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+    
+    def _run(self):
+        while True:
+            check_redis()
+            self.flush()
+            time.sleep(self.flush_interval)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+metrics = MetricsRegistry(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+metrics.inc('gps_redis_checks_total', result='ok' if REDIS_AVAILABLE else 'failed')
+_redis_up = REDIS_AVAILABLE
+metrics.gauge('gps_redis_up', lambda: {(): 1 if _redis_up else 0}, aggregate=max)
+
+def check_redis():
+    """定期检查Redis连通性（只用于监控，启动时确定的缓存模式不会切换）"""
+    global _redis_up
+    try:
+        redis_client.ping()
+        _redis_up = True
+    except Exception:
+        _redis_up = False
+    metrics.inc('gps_redis_checks_total', result='ok' if _redis_up else 'failed')
+
+_request_local = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+def _record_sql(conn):
+    started = conn.info.get('metrics_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if getattr(_request_local, 'active', False):
+        _request_local.statements += 1
+        _request_local.sql_seconds += elapsed
+    else:
+        metrics.inc('gps_sql_statements_total', endpoint='background')
+        metrics.inc('gps_sql_seconds_total', elapsed, endpoint='background')
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    _record_sql(conn)
+
+@event.listens_for(Engine, 'handle_error')
+def _sql_failed(context):
+    """执行出错的语句不会触发 after_cursor_execute，这里同样出栈计时"""
+    if context.connection is not None and context.execution_context is not None:
+        _record_sql(context.connection)
+
+class SlowRequestProfiler:
+    """慢请求采样分析：请求处理期间定时采样其线程的调用栈，超过阈值时记录最常出现的调用栈"""
+    
+    MAX_DEPTH = 30
+    
+    def __init__(self, interval, keep=20):
+        self.interval = interval
+        self.recent = deque(maxlen=keep)
+        self._active = {}  # 线程ID -> 调用栈采样计数
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+    
+    def begin(self):
+        """开始采样当前线程"""
+        with self._lock:
+            self._active[threading.get_ident()] = {}
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+    
+    def end(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+    
+    def record(self, endpoint, method, duration, samples, top=5):
+        """保存并输出一次慢请求的采样结果"""
+        total = sum(samples.values())
+        stacks = sorted(samples.items(), key=lambda item: item[1], reverse=True)[:top]
+        entry = {
+            'endpoint': endpoint,
+            'method': method,
+            'duration_ms': round(duration * 1000, 1),
+            'samples': total,
+            'time': datetime.utcnow().isoformat(),
+            'stacks': [{'count': count, 'stack': stack} for stack, count in stacks]
+        }
+        self.recent.append(entry)
+        metrics.inc('gps_slow_requests_total', endpoint=endpoint)
+        if stacks:
+            logger.warning(f"慢请求 {method} {endpoint} {entry['duration_ms']}ms, 采样{total}次, 最频繁调用栈: {stacks[0][0]}")
+    
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                idle = not self._active
+            if idle:
+                self._wakeup.clear()
+                self._wakeup.wait(1.0)
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None or ident == own:
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < self.MAX_DEPTH:
+                        code = frame.f_code
+                        stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    samples[key] = samples.get(key, 0) + 1
+            time.sleep(self.interval)
+
+slow_request_profiler = SlowRequestProfiler(app.config['PROFILE_SAMPLE_INTERVAL'])
+
+@app.before_request
+def start_request_metrics():
+    """请求计时与SQL计数；开启慢请求分析时开始采样"""
+    g.metrics_started = time.perf_counter()
+    _request_local.active = True
+    _request_local.statements = 0
+    _request_local.sql_seconds = 0.0
+    g.profile_threshold = app.config['SLOW_REQUEST_PROFILE_MS']
+    if g.profile_threshold > 0:
+        slow_request_profiler.begin()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    statements = _request_local.statements
+    metrics.inc('gps_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics.observe('gps_http_request_duration_seconds', duration, endpoint=endpoint, method=request.method)
+    metrics.observe('gps_sql_statements_per_request', statements, buckets=STATEMENT_BUCKETS, endpoint=endpoint)
+    metrics.inc('gps_sql_statements_total', statements, endpoint=endpoint)
+    metrics.inc('gps_sql_seconds_total', _request_local.sql_seconds, endpoint=endpoint)
+    
+    if g.get('profile_threshold', 0) > 0:
+        samples = slow_request_profiler.end()
+        if samples is not None and duration * 1000 >= g.profile_threshold:
+            slow_request_profiler.record(endpoint, request.method, duration, samples)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    _request_local.active = False
+    if g.get('profile_threshold', 0) > 0:
+        slow_request_profiler.end()
+
 # ==================== 数据库模型 ====================
 
 class Admin(db.Model):
@@ -104,6 +605,14 @@ class Device(db.Model):
     # 关系
     owner = db.relationship('VehicleOwner', backref='devices')
     vehicle_model = db.relationship('VehicleModel', backref='devices')
+    
+    # 设备列表的筛选条件（SQLite二级索引隐含rowid，可直接按id做键集分页）
+    __table_args__ = (
+        db.Index('idx_device_status', 'status'),
+        db.Index('idx_device_model', 'vehicle_model_id'),
+        db.Index('idx_device_owner', 'owner_id'),
+        db.Index('idx_device_plate', 'vehicle_plate'),
+    )
 
 class DeviceAppPermission(db.Model):
     """设备-软件授权表"""
@@ -153,8 +662,161 @@ class SystemConfig(db.Model):
     description = db.Column(db.String(200))
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class CacheVersion(db.Model):
+    """缓存版本号表（无Redis时用于跨进程缓存失效）"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AlarmEvent(db.Model):
+    """报警事件表（围栏进出、超速等）"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    event_type = db.Column(db.String(20), nullable=False)  # fence_enter, fence_exit, overspeed
+    fence_id = db.Column(db.Integer, db.ForeignKey('electronic_fence.id'))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    speed = db.Column(db.Float)
+    event_time = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('idx_alarm_device_time', 'device_id', 'event_time'),)
+
+class DeviceDailyStats(db.Model):
+    """设备每日统计表（写入时增量更新）"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    stat_date = db.Column(db.Date, nullable=False)
+    distance = db.Column(db.Float, default=0)  # 行驶里程（米）
+    moving_seconds = db.Column(db.Integer, default=0)  # 行驶时长（秒）
+    max_speed = db.Column(db.Float, default=0)  # 最高速度（km/h）
+    stop_count = db.Column(db.Integer, default=0)  # 停车次数
+    point_count = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('device_id', 'stat_date', name='uq_daily_device_date'),
+        db.Index('idx_daily_date', 'stat_date'),
+    )
+
+class FrequentPlace(db.Model):
+    """常去地点表（停车点按geohash网格聚类）"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    geohash = db.Column(db.String(12), nullable=False)
+    latitude = db.Column(db.Float, nullable=False)  # 网格内停车点的平均位置
+    longitude = db.Column(db.Float, nullable=False)
+    visit_count = db.Column(db.Integer, default=0)
+    total_dwell_seconds = db.Column(db.Integer, default=0)
+    first_visit = db.Column(db.DateTime)
+    last_visit = db.Column(db.DateTime)
+    
+    __table_args__ = (db.UniqueConstraint('device_id', 'geohash', name='uq_place_device_geohash'),)
+
+class TrackSegment(db.Model):
+    """轨迹归档表（每设备每时间窗口一段，差分编码压缩）"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    window_start = db.Column(db.DateTime, nullable=False)  # 所属时间窗口起点
+    start_time = db.Column(db.DateTime, nullable=False)  # 段内第一个点的时间
+    end_time = db.Column(db.DateTime, nullable=False)  # 段内最后一个点的时间
+    point_count = db.Column(db.Integer, default=0)
+    data = db.Column(db.LargeBinary, nullable=False)
+    # 段内最后一个点的坐标（1e-6度），作为追加新点时的差分起点；为空表示旧格式，下次写入时整段重写
+    last_latitude = db.Column(db.Integer)
+    last_longitude = db.Column(db.Integer)
+    
+    __table_args__ = (
+        db.Index('idx_track_device_range', 'device_id', 'start_time', 'end_time'),
+        db.UniqueConstraint('device_id', 'window_start', name='uq_track_device_window'),
+        db.Index('idx_track_end', 'end_time'),
+    )
+
+class TrackRollup(db.Model):
+    """轨迹降采样表：超过保留期的轨迹按 resolution 秒分桶，每桶保留一个点"""
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(100), nullable=False)
+    resolution = db.Column(db.Integer, nullable=False)  # 分桶秒数：60 或 600
+    window_start = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    point_count = db.Column(db.Integer, default=0)
+    data = db.Column(db.LargeBinary, nullable=False)
+    
+    __table_args__ = (
+        db.Index('idx_rollup_device_range', 'device_id', 'resolution', 'start_time', 'end_time'),
+        db.Index('idx_rollup_end', 'resolution', 'end_time'),
+        db.UniqueConstraint('device_id', 'resolution', 'window_start', name='uq_rollup_device_window'),
+    )
+
+# ==================== 位置数据分片 ====================
+
+class LocationShards:
+    """位置类数据按 device_id 哈希分布到多个SQLite文件，每个文件有独立的写锁；
+    设备、车主、软件等控制面表始终在主库"""
+    
+    MODELS = (LocationCurrent, TrackSegment, TrackRollup, AlarmEvent, DeviceDailyStats, FrequentPlace)
+    
+    def __init__(self, count, directory):
+        self.count = max(1, count)
+        self.directory = directory
+        self._engines = None
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self):
+        return self.count > 1
+    
+    def index(self, device_id):
+        """设备所在分片（crc32 跨进程稳定，不能用内置 hash）"""
+        if not self.enabled:
+            return 0
+        return zlib.crc32(device_id.encode('utf-8')) % self.count
+    
+    def engines(self):
+        """全部分片的引擎；不分片时即主库引擎"""
+        if not self.enabled:
+            return [db.engine]
+        if self._engines is None:
+            with self._lock:
+                if self._engines is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    engines = []
+                    for i in range(self.count):
+                        path = os.path.join(self.directory, f'gps_locations_{i}.db')
+                        engine = create_engine(f'sqlite:///{path}')
+                        for model in self.MODELS:
+                            model.__table__.create(engine, checkfirst=True)
+                            upgrade_table(engine, model.__table__)
+                        engines.append(engine)
+                    self._engines = engines
+                    logger.info(f"位置数据分片已就绪: {self.count} 个, 目录 {self.directory}")
+        return self._engines
+    
+    def engine(self, device_id):
+        return self.engines()[self.index(device_id)]
+    
+    def group(self, device_ids):
+        """把设备按分片分组：{分片序号: [device_id, ...]}"""
+        groups = {}
+        for device_id in device_ids:
+            groups.setdefault(self.index(device_id), []).append(device_id)
+        return groups
+    
+    def fetch_all(self, stmt):
+        """在每个分片上执行同一查询并拼接结果（跨设备查询用）"""
+        rows = []
+        for engine in self.engines():
+            with engine.connect() as conn:
+                rows.extend(conn.execute(stmt).all())
+        return rows
+
+location_shards = LocationShards(app.config['LOCATION_SHARDS'], app.config['LOCATION_SHARD_DIR'])
+
 # ==================== 工具函数 ====================
 
+GPSPoint = namedtuple('GPSPoint', ['latitude', 'longitude', 'altitude', 'accuracy', 'speed', 'heading', 'timestamp'])
+
 def compress_gps_data(locations):
     """GPS数据压缩"""
     if not locations:
@@ -186,6 +848,161 @@ def decompress_gps_data(compressed_data):
     except:
         return []
 
+# 轨迹段二进制格式：版本号 + 点数 + 逐点记录，整数均为varint（有符号数先做zigzag）
+# 逐点记录：字段标记、时间差(秒)、纬度差、经度差(1e-6度)，之后按标记依次为
+# 速度(0.1km/h)、方向(0.1度)、海拔(0.1米)、精度(0.1米)
+TRACK_FORMAT_VERSION = 1
+# 可追加格式（归档中的轨迹段）：版本号后直接是逐点记录，不记点数，读到末尾为止；
+# 以段内最后一个点为差分起点编码新点，拼接到末尾即可，不必解码整段
+TRACK_APPEND_FORMAT_VERSION = 2
+TRACK_EPOCH = datetime(1970, 1, 1)
+_TRACK_OPTIONAL_FIELDS = ('speed', 'heading', 'altitude', 'accuracy')
+
+def _write_varint(buf, value):
+    value = (value << 1) if value >= 0 else ((-value) << 1) - 1
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    value = (result >> 1) if not result & 1 else -((result + 1) >> 1)
+    return value, pos
+
+def _encode_track_records(buf, points, previous=(0, 0, 0)):
+    """逐点记录写入buf，previous 为差分起点；返回最后一个点的 (秒, 纬度, 经度) 整数值"""
+    prev_time, prev_lat, prev_lng = previous
+    for point in points:
+        seconds = int((point.timestamp - TRACK_EPOCH).total_seconds())
+        lat = round(point.latitude * 1e6)
+        lng = round(point.longitude * 1e6)
+        
+        flags = 0
+        extras = []
+        for bit, field in enumerate(_TRACK_OPTIONAL_FIELDS):
+            value = getattr(point, field)
+            if value is not None:
+                flags |= 1 << bit
+                extras.append(round(value * 10))
+        
+        _write_varint(buf, flags)
+        _write_varint(buf, seconds - prev_time)
+        _write_varint(buf, lat - prev_lat)
+        _write_varint(buf, lng - prev_lng)
+        for value in extras:
+            _write_varint(buf, value)
+        prev_time, prev_lat, prev_lng = seconds, lat, lng
+    return prev_time, prev_lat, prev_lng
+
+def encode_track_points(points):
+    """按时间排序的GPSPoint列表编码为紧凑的差分二进制"""
+    buf = bytearray([TRACK_FORMAT_VERSION])
+    _write_varint(buf, len(points))
+    _encode_track_records(buf, points)
+    return bytes(buf)
+
+def encode_track_chunk(points, previous=None):
+    """编码为可追加格式，返回 (二进制, 最后一个点的 (秒, 纬度, 经度))；
+    previous 为段内最后一个点时只编码新点的记录，直接拼接到段末尾"""
+    buf = bytearray() if previous else bytearray([TRACK_APPEND_FORMAT_VERSION])
+    last = _encode_track_records(buf, points, previous or (0, 0, 0))
+    return bytes(buf), last
+
+def decode_track_points(data):
+    """解码轨迹段二进制（两种格式），返回GPSPoint列表"""
+    if not data or data[0] not in (TRACK_FORMAT_VERSION, TRACK_APPEND_FORMAT_VERSION):
+        return []
+    
+    if data[0] == TRACK_FORMAT_VERSION:
+        count, pos = _read_varint(data, 1)
+    else:
+        count, pos = None, 1
+    points = []
+    seconds = lat = lng = 0
+    while (len(points) < count) if count is not None else (pos < len(data)):
+        flags, pos = _read_varint(data, pos)
+        delta, pos = _read_varint(data, pos)
+        seconds += delta
+        delta, pos = _read_varint(data, pos)
+        lat += delta
+        delta, pos = _read_varint(data, pos)
+        lng += delta
+        
+        extras = {}
+        for bit, field in enumerate(_TRACK_OPTIONAL_FIELDS):
+            if flags & (1 << bit):
+                value, pos = _read_varint(data, pos)
+                extras[field] = value / 10
+        
+        points.append(GPSPoint(
+            latitude=lat / 1e6,
+            longitude=lng / 1e6,
+            altitude=extras.get('altitude'),
+            accuracy=extras.get('accuracy'),
+            speed=extras.get('speed'),
+            heading=extras.get('heading'),
+            timestamp=TRACK_EPOCH + timedelta(seconds=seconds)
+        ))
+    return points
+
+# 二进制批量上传格式：魔数 + 设备ID（varint长度 + UTF-8）+ 轨迹段编码的点
+GPS_BATCH_CONTENT_TYPE = 'application/x-gps-batch'
+GPS_BATCH_MAGIC = b'GPSB'
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 解压后上限，防止压缩炸弹
+
+def encode_gps_batch(device_id, points):
+    """编码二进制批量上传数据（供车机端和测试使用）"""
+    buf = bytearray(GPS_BATCH_MAGIC)
+    device_bytes = device_id.encode('utf-8')
+    _write_varint(buf, len(device_bytes))
+    buf += device_bytes
+    return bytes(buf) + encode_track_points(points)
+
+def decode_gps_batch(data):
+    """解码二进制批量上传数据，返回 (device_id, 点列表)，格式错误抛出ValueError"""
+    if data[:4] != GPS_BATCH_MAGIC:
+        raise ValueError('无效的数据头')
+    try:
+        length, pos = _read_varint(data, 4)
+        device_id = data[pos:pos + length].decode('utf-8')
+        if data[pos + length] != TRACK_FORMAT_VERSION:
+            raise ValueError('不支持的数据版本')
+        points = decode_track_points(data[pos + length:])
+    except (IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f'数据截断或损坏: {e}')
+    return device_id, points
+
+def gunzip_limited(data, limit=MAX_UPLOAD_BYTES):
+    """解压gzip数据，超过上限抛出ValueError"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        result = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        logger.warning(f"gzip解压失败: {e}")
+        raise ValueError('gzip解压失败')
+    if decompressor.unconsumed_tail:
+        raise ValueError('解压后数据过大')
+    return result
+
+def parse_timestamp(text):
+    """解析ISO格式时间；带时区的（如 Z、+08:00）换算为UTC，统一返回不带时区的UTC时间"""
+    # Python 3.11 之前的 fromisoformat 不认识结尾的 Z
+    if text[-1:] in ('Z', 'z'):
+        text = text[:-1] + '+00:00'
+    timestamp = datetime.fromisoformat(text)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """计算两点间距离（米）"""
     R = 6371000  # 地球半径（米）
@@ -202,6 +1019,47 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     
     return R * c
 
+def calculate_distances(lats1, lons1, lats2, lons2):
+    """批量计算两组坐标间距离（米），逐项对应"""
+    R = 6371000
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    
+    distances = []
+    for lat1, lon1, lat2, lon2 in zip(lats1, lons1, lats2, lons2):
+        phi1 = radians(lat1)
+        phi2 = radians(lat2)
+        a = (sin((phi2 - phi1) / 2) ** 2 +
+             cos(phi1) * cos(phi2) * sin(radians(lon2 - lon1) / 2) ** 2)
+        distances.append(2 * R * asin(sqrt(min(1.0, a))))
+    return distances
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def encode_geohash(lat, lng, precision=7):
+    """计算geohash编码"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
 def is_same_location(lat1, lon1, lat2, lon2, threshold=50):
     """判断是否为相同位置（防抖）"""
     distance = calculate_distance(lat1, lon1, lat2, lon2)
@@ -216,6 +1074,99 @@ def calculate_speed(lat1, lon1, time1, lat2, lon2, time2):
     speed_ms = distance / time_diff
     return speed_ms * 3.6  # 转换为km/h
 
+def calculate_speeds(points, previous=None, max_speed=300):
+    """批量计算每个点相对前一点的速度（km/h），间隔不足1秒或疑似漂移时使用上报速度"""
+    chain = ([previous] if previous is not None else []) + list(points)
+    distances = calculate_distances(
+        [p.latitude for p in chain[:-1]], [p.longitude for p in chain[:-1]],
+        [p.latitude for p in chain[1:]], [p.longitude for p in chain[1:]]
+    )
+    offset = len(chain) - len(points)
+    
+    speeds = []
+    for i, point in enumerate(points):
+        j = i + offset  # 该点在chain中的位置
+        speed = None
+        if j > 0:
+            time_diff = (point.timestamp - chain[j - 1].timestamp).total_seconds()
+            if time_diff >= 1:
+                speed = distances[j - 1] / time_diff * 3.6
+        if speed is None or speed > max_speed:
+            speed = point.speed or 0
+        speeds.append(speed)
+    return speeds
+
+def douglas_peucker_ranks(lats, lngs):
+    """计算每个点的Douglas-Peucker重要度（米）：容差小于该值时该点被保留，首尾点为无穷大"""
+    n = len(lats)
+    ranks = [0.0] * n
+    if n == 0:
+        return ranks
+    ranks[0] = ranks[-1] = math.inf
+    
+    # 投影到以首点为基准的平面坐标（米），轨迹范围内误差可忽略
+    lng_scale = 111320 * math.cos(math.radians(lats[0]))
+    xs = [lng * lng_scale for lng in lngs]
+    ys = [lat * 110540 for lat in lats]
+    
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, parent_rank = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1, x2, y2 = xs[first], ys[first], xs[last], ys[last]
+        dx, dy = x2 - x1, y2 - y1
+        seg_len2 = dx * dx + dy * dy
+        
+        max_dist2, index = -1.0, first + 1
+        for i in range(first + 1, last):
+            px, py = xs[i] - x1, ys[i] - y1
+            if seg_len2 > 0:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / seg_len2))
+                px, py = px - t * dx, py - t * dy
+            dist2 = px * px + py * py
+            if dist2 > max_dist2:
+                max_dist2, index = dist2, i
+        
+        # 子区间的点重要度不超过父节点，保证按阈值筛选与标准DP算法结果一致
+        rank = min(math.sqrt(max_dist2), parent_rank)
+        ranks[index] = rank
+        stack.append((first, index, rank))
+        stack.append((index, last, rank))
+    return ranks
+
+def simplify_track(points, tolerance=None, max_points=None, zoom=None):
+    """轨迹抽稀：按容差（米）或最大点数保留关键点；zoom为地图级别，换算为一个像素对应的米数作为容差"""
+    # 用紧凑数组收集坐标，避免一周的轨迹在内存中展开为大量对象
+    lats, lngs, altitudes, speeds, times = array('d'), array('d'), array('d'), array('d'), array('d')
+    for point in points:
+        lats.append(point.latitude)
+        lngs.append(point.longitude)
+        altitudes.append(math.nan if point.altitude is None else point.altitude)
+        speeds.append(math.nan if point.speed is None else point.speed)
+        times.append((point.timestamp - TRACK_EPOCH).total_seconds())
+    if not lats:
+        return
+    
+    if tolerance is None and zoom is not None:
+        tolerance = 156543.03 * math.cos(math.radians(lats[0])) / (2 ** zoom)
+    
+    ranks = douglas_peucker_ranks(lats, lngs)
+    keep = [i for i in range(len(lats)) if ranks[i] > tolerance] if tolerance else list(range(len(lats)))
+    if max_points and len(keep) > max_points:
+        keep = sorted(heapq.nlargest(max_points, keep, key=ranks.__getitem__))
+    
+    for i in keep:
+        yield GPSPoint(
+            latitude=lats[i],
+            longitude=lngs[i],
+            altitude=None if math.isnan(altitudes[i]) else altitudes[i],
+            accuracy=None,
+            speed=None if math.isnan(speeds[i]) else speeds[i],
+            heading=None,
+            timestamp=TRACK_EPOCH + timedelta(seconds=times[i])
+        )
+
 def check_storage_usage():
     """检查存储使用情况"""
     total, used, free = shutil.disk_usage('/')
@@ -229,7 +1180,7 @@ def check_storage_usage():
         'used_gb': used / (1024**3)
     }
 
-def send_storage_alert():
+def send_storage_alert(storage_info=None):
     """发送存储不足邮件"""
     try:
         # 获取邮件配置
@@ -238,13 +1189,15 @@ def send_storage_alert():
             logger.error("邮件配置不存在")
             return False
         
-        msg = MimeMultipart()
+        msg = MIMEMultipart()
         msg['From'] = smtp_config.get('from_email')
         msg['To'] = smtp_config.get('to_email')
         msg['Subject'] = "服务器容量不足警告"
         
         body = "服务器容量不足，请及时处理"
-        msg.attach(MimeText(body, 'plain', 'utf-8'))
+        if storage_info:
+            body += f"\n\n磁盘使用率: {storage_info['usage_percent']:.1f}%\n剩余空间: {storage_info['free_gb']:.1f} GB"
+        msg.attach(MIMEText(body, 'plain', 'utf-8'))
         
         server = smtplib.SMTP(smtp_config.get('smtp_host'), smtp_config.get('smtp_port'))
         server.starttls()
@@ -258,15 +1211,119 @@ def send_storage_alert():
         logger.error(f"发送邮件失败: {e}")
         return False
 
+class VersionCounter:
+    """跨进程共享的版本号：Redis可用时用INCR，否则存数据库，用于通知其他工作进程缓存失效"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.redis_key = f'gps:version:{name}'
+    
+    def get(self):
+        if REDIS_AVAILABLE:
+            try:
+                return int(redis_client.get(self.redis_key) or 0)
+            except redis.RedisError as e:
+                logger.warning(f"读取版本号失败: {e}")
+        table = CacheVersion.__table__
+        return db.session.execute(db.select(table.c.version).where(table.c.name == self.name)).scalar() or 0
+    
+    def bump(self, conn=None):
+        """递增版本号（数据库模式下在 conn 或当前会话的事务中执行，随之一起提交）"""
+        if REDIS_AVAILABLE:
+            try:
+                return redis_client.incr(self.redis_key)
+            except redis.RedisError as e:
+                logger.warning(f"更新版本号失败: {e}")
+        table = CacheVersion.__table__
+        stmt = sqlite_insert(table).values(name=self.name, version=1, updated_at=datetime.utcnow())
+        (conn or db.session).execute(stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': table.c.version + 1, 'updated_at': stmt.excluded.updated_at}
+        ))
+    
+    def bump_on_commit(self, session, conn=None):
+        """随会话事务递增：数据库模式下在事务中执行、一起提交（flush事件中传入 conn）；
+        Redis模式下等提交后再递增，避免其他进程在提交前看到新版本号、按旧数据重新加载"""
+        if REDIS_AVAILABLE:
+            session.info.setdefault('pending_versions', set()).add(self)
+        else:
+            self.bump(conn or session)
+
+@event.listens_for(db.session, 'after_commit')
+def on_version_session_commit(session):
+    for counter in session.info.pop('pending_versions', ()):
+        try:
+            redis_client.incr(counter.redis_key)
+        except redis.RedisError as e:
+            logger.warning(f"更新版本号失败: {e}")
+
+@event.listens_for(db.session, 'after_rollback')
+def on_version_session_rollback(session):
+    session.info.pop('pending_versions', None)
+
+def parse_config_value(text):
+    """配置文本解析为Python值"""
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        # set_system_config 对布尔值写入的是 str(value)
+        if text in ('True', 'False'):
+            return text == 'True'
+        return text
+
+class ConfigCache:
+    """系统配置缓存：一次加载全部配置并解析，读取走内存；
+    每隔 check_interval 秒检查一次版本号，其他进程修改配置后在该间隔内重新加载"""
+    
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.version = VersionCounter('config')
+        self._values = None
+        self._loaded_version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+    
+    def _ensure_fresh(self):
+        if self._values is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._values is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                version = self.version.get()
+                if self._values is None or version != self._loaded_version:
+                    rows = db.session.execute(db.select(SystemConfig.config_key, SystemConfig.config_value)).all()
+                    self._values = {row.config_key: parse_config_value(row.config_value) for row in rows}
+                    self._loaded_version = version
+            except Exception as e:
+                logger.error(f"加载系统配置失败: {e}")
+                if self._values is None:
+                    self._values = {}
+    
+    def load(self):
+        """立即加载全部配置"""
+        self.invalidate()
+        self._ensure_fresh()
+    
+    def get(self, key, default=None):
+        self._ensure_fresh()
+        value = self._values.get(key)
+        return default if value is None else value
+    
+    def invalidate(self):
+        """丢弃本进程缓存，下次读取时重新加载"""
+        with self._lock:
+            self._values = None
+
+config_cache = ConfigCache(check_interval=app.config['CONFIG_CHECK_INTERVAL'])
+
 def get_system_config(key, default=None):
     """获取系统配置"""
-    config = SystemConfig.query.filter_by(config_key=key).first()
-    if config:
-        try:
-            return json.loads(config.config_value)
-        except:
-            return config.config_value
-    return default
+    return config_cache.get(key, default)
 
 def set_system_config(key, value, description=""):
     """设置系统配置"""
@@ -281,135 +1338,2258 @@ def set_system_config(key, value, description=""):
             description=description
         )
         db.session.add(config)
+    config_cache.version.bump_on_commit(db.session)
     db.session.commit()
+    config_cache.invalidate()
 
-# ==================== 认证装饰器 ====================
-
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'admin_id' not in session:
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+# ==================== 最新位置缓存 ====================
 
-# ==================== 路由定义 ====================
+def position_to_dict(point):
+    """位置点（GPSPoint或数据库行）转为缓存/接口使用的字典"""
+    return {
+        'latitude': point.latitude,
+        'longitude': point.longitude,
+        'altitude': point.altitude,
+        'accuracy': point.accuracy,
+        'speed': point.speed,
+        'heading': point.heading,
+        'timestamp': point.timestamp.isoformat()
+    }
 
-@app.route('/')
-def index():
-    """首页重定向到管理后台"""
-    return redirect(url_for('admin_dashboard'))
+def load_latest_positions(device_ids=None):
+    """从数据库读取设备最新位置，每个分片一次查询"""
+    table = LocationCurrent.__table__
+    if device_ids is None:
+        groups = {index: None for index in range(location_shards.count)}
+    else:
+        groups = location_shards.group(device_ids)
+    
+    engines = location_shards.engines()
+    positions = {}
+    for index, ids in groups.items():
+        latest = db.select(table.c.device_id, db.func.max(table.c.timestamp).label('max_timestamp')).group_by(table.c.device_id)
+        if ids is not None:
+            latest = latest.where(table.c.device_id.in_(ids))
+        latest = latest.subquery()
+        
+        with engines[index].connect() as conn:
+            rows = conn.execute(
+                db.select(table).join(latest, db.and_(
+                    table.c.device_id == latest.c.device_id,
+                    table.c.timestamp == latest.c.max_timestamp
+                ))
+            ).all()
+        positions.update((row.device_id, position_to_dict(row)) for row in rows)
+    return positions
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    """管理员登录"""
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
+class LatestPositionStore:
+    """设备最新位置缓存：Redis可用时存Redis哈希（多进程共享），否则用有界的进程内字典"""
+    
+    REDIS_KEY = 'gps:latest'
+    
+    # 只有时间更新的位置才覆盖缓存，避免乱序上传把旧位置写回
+    UPDATE_SCRIPT = """
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current and cjson.decode(current)['timestamp'] > ARGV[3] then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+    
+    def __init__(self, maxsize, local_ttl):
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()  # device_id -> (位置字典, 缓存时间)
+        self._lock = threading.Lock()
+        self._update_script = redis_client.register_script(self.UPDATE_SCRIPT) if REDIS_AVAILABLE else None
+    
+    def update(self, device_id, position):
+        """写入设备最新位置（position 为位置字典）"""
+        self.update_many({device_id: position})
+    
+    def update_many(self, positions):
+        if REDIS_AVAILABLE:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for device_id, position in positions.items():
+                    self._update_script(
+                        keys=[self.REDIS_KEY],
+                        args=[device_id, json.dumps(position), position['timestamp']],
+                        client=pipe
+                    )
+                pipe.execute()
+                return
+            except redis.RedisError as e:
+                logger.warning(f"写入Redis位置缓存失败: {e}")
         
-        admin = Admin.query.filter_by(username=username).first()
-        if admin and check_password_hash(admin.password_hash, password):
-            session['admin_id'] = admin.id
-            session['admin_username'] = admin.username
-            admin.last_login = datetime.utcnow()
-            db.session.commit()
-            return redirect(url_for('admin_dashboard'))
-        else:
-            flash('用户名或密码错误', 'error')
+        now = time.monotonic()
+        with self._lock:
+            for device_id, position in positions.items():
+                current = self._local.get(device_id)
+                if current and current[0]['timestamp'] > position['timestamp']:
+                    continue
+                self._local[device_id] = (position, now)
+                self._local.move_to_end(device_id)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
     
-    return render_template('login.html')
+    def get(self, device_id):
+        """读取设备最新位置，未命中返回None"""
+        return self.get_many([device_id]).get(device_id)
+    
+    def get_many(self, device_ids):
+        """批量读取，只返回命中的设备"""
+        if not device_ids:
+            return {}
+        if REDIS_AVAILABLE:
+            try:
+                values = redis_client.hmget(self.REDIS_KEY, device_ids)
+                return {device_id: json.loads(value) for device_id, value in zip(device_ids, values) if value}
+            except redis.RedisError as e:
+                logger.warning(f"读取Redis位置缓存失败: {e}")
+        
+        # 多进程部署时其他进程的写入在本进程不可见，超过有效期的条目视为未命中
+        expire_before = time.monotonic() - self.local_ttl
+        result = {}
+        with self._lock:
+            for device_id in device_ids:
+                entry = self._local.get(device_id)
+                if entry and entry[1] >= expire_before:
+                    result[device_id] = entry[0]
+        return result
+    
+    def get_or_load_many(self, device_ids):
+        """批量读取，未命中的设备一次查询数据库补齐并回填缓存"""
+        positions = self.get_many(device_ids)
+        missing = [device_id for device_id in device_ids if device_id not in positions]
+        if missing:
+            loaded = load_latest_positions(missing)
+            if loaded:
+                self.update_many(loaded)
+                positions.update(loaded)
+        return positions
+    
+    def warm_up(self):
+        """冷启动时从数据库加载所有设备的最新位置"""
+        positions = load_latest_positions()
+        if positions:
+            self.update_many(positions)
+        logger.info(f"最新位置缓存预热完成: {len(positions)} 台设备")
+        return len(positions)
+    
+    def check_consistency(self):
+        """对比缓存与数据库的最新位置，返回缺失和不一致的设备"""
+        stored = load_latest_positions()
+        cached = self.get_many(list(stored))
+        missing = [device_id for device_id in stored if device_id not in cached]
+        mismatched = [
+            {'device_id': device_id, 'cached': cached[device_id], 'stored': position}
+            for device_id, position in stored.items()
+            if device_id in cached and cached[device_id] != position
+        ]
+        return {
+            'checked': len(stored),
+            'missing': missing,
+            'mismatched': mismatched,
+            'consistent': not mismatched
+        }
 
-@app.route('/logout')
-def logout():
-    """退出登录"""
-    session.clear()
-    return redirect(url_for('login'))
+latest_positions = LatestPositionStore(
+    maxsize=app.config['LATEST_CACHE_SIZE'],
+    local_ttl=app.config['LATEST_CACHE_TTL']
+)
 
-@app.route('/admin/dashboard')
-@login_required
-def admin_dashboard():
-    """管理后台首页"""
-    # 统计数据
-    stats = {
-        'total_devices': Device.query.count(),
-        'online_devices': Device.query.filter_by(status='online').count(),
-        'total_owners': VehicleOwner.query.count(),
-        'total_software': Software.query.filter_by(is_active=True).count(),
-        'storage_info': check_storage_usage()
-    }
+# ==================== 附近车辆查询 ====================
+
+EARTH_RADIUS = 6371000
+
+class PositionIndex:
+    """最新位置的空间网格索引：上传时原地更新，附近车辆与地图范围查询只扫描相关网格
+    
+    网格按经度直接划分，不跨越180°经线（该经线两侧的设备互相视为很远）
+    """
+    
+    def __init__(self, cell_size, reload_seconds):
+        self.cell_size = cell_size
+        self.reload_seconds = reload_seconds
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._positions = {}  # device_id -> (网格, 位置字典)
+        self._grid = {}  # (行, 列) -> {device_id}
+    
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+    
+    def _put(self, device_id, position):
+        current = self._positions.get(device_id)
+        if current:
+            if current[1]['timestamp'] > position['timestamp']:
+                return
+            self._discard(device_id, current[0])
+        cell = self._cell(position['latitude'], position['longitude'])
+        self._positions[device_id] = (cell, position)
+        self._grid.setdefault(cell, set()).add(device_id)
+    
+    def _discard(self, device_id, cell):
+        devices = self._grid.get(cell)
+        if devices:
+            devices.discard(device_id)
+            if not devices:
+                del self._grid[cell]
+    
+    def update_many(self, positions):
+        """写入设备最新位置（positions: device_id -> 位置字典），旧于当前的位置忽略"""
+        with self._lock:
+            for device_id, position in positions.items():
+                self._put(device_id, position)
+    
+    def remove(self, device_id):
+        with self._lock:
+            current = self._positions.pop(device_id, None)
+            if current:
+                self._discard(device_id, current[0])
+    
+    def load(self):
+        """从数据库全量重建索引；比数据库更新的位置（重建期间的写入）保留，已删除的设备在查询时剔除"""
+        positions = load_latest_positions()
+        with self._lock:
+            previous = self._positions
+            self._positions, self._grid = {}, {}
+            for device_id, position in positions.items():
+                self._put(device_id, position)
+            for device_id, (cell, position) in previous.items():
+                self._put(device_id, position)
+            self._loaded_at = time.monotonic()
+        logger.info(f"位置空间索引加载完成: {len(positions)} 台设备")
+        return len(positions)
+    
+    def _refresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.reload_seconds:
+            self.load()
+    
+    def within_bbox(self, min_lat, min_lng, max_lat, max_lng, limit):
+        """范围内的设备，返回 (结果列表, 是否截断)，结果为 (device_id, 位置字典)"""
+        self._refresh()
+        min_row, min_col = self._cell(min_lat, min_lng)
+        max_row, max_col = self._cell(max_lat, max_lng)
+        results = []
+        with self._lock:
+            # 范围覆盖的网格比有车的网格还多时，直接遍历有车的网格
+            if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self._grid):
+                cells = [cell for cell in self._grid
+                         if min_row <= cell[0] <= max_row and min_col <= cell[1] <= max_col]
+            else:
+                cells = [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+            for cell in cells:
+                for device_id in self._grid.get(cell, ()):
+                    position = self._positions[device_id][1]
+                    if min_lat <= position['latitude'] <= max_lat and min_lng <= position['longitude'] <= max_lng:
+                        if len(results) >= limit:
+                            return results, True
+                        results.append((device_id, position))
+        return results, False
+    
+    def _covered_radius(self, lat, lng, row, col, ring):
+        """已扫描的 (2*ring+1)^2 个网格内切圆半径（米），更远的设备一定在圈外"""
+        size = self.cell_size
+        lat_gap = min(lat - (row - ring) * size, (row + ring + 1) * size - lat)
+        lng_gap = min(lng - (col - ring) * size, (col + ring + 1) * size - lng)
+        lat_distance = EARTH_RADIUS * math.radians(lat_gap)
+        # 到相隔 Δλ 的经线的最短大圆距离为 R·asin(cosφ·sinΔλ)
+        lng_distance = EARTH_RADIUS * math.asin(
+            min(1.0, math.cos(math.radians(lat)) * math.sin(math.radians(min(lng_gap, 90))))
+        )
+        return min(lat_distance, lng_distance)
+    
+    def _rings(self, row, col):
+        """由近到远逐圈产出有车的网格；圈内网格数超过有车网格数后，改为把有车的网格按圈号分组"""
+        ring = 0
+        while (2 * ring + 1) ** 2 <= len(self._grid):
+            if ring == 0:
+                cells = [(row, col)]
+            else:
+                cells = [(row + dr, col + dc) for dr in range(-ring, ring + 1) for dc in (-ring, ring)]
+                cells += [(row + dr, col + dc) for dr in (-ring, ring) for dc in range(-ring + 1, ring)]
+            yield ring, [cell for cell in cells if cell in self._grid]
+            ring += 1
+        
+        groups = {}
+        for cell in self._grid:
+            distance = max(abs(cell[0] - row), abs(cell[1] - col))
+            if distance >= ring:
+                groups.setdefault(distance, []).append(cell)
+        for distance in sorted(groups):
+            yield distance, groups[distance]
     
-    # 最近位置更新
-    recent_locations = db.session.query(LocationCurrent).order_by(LocationCurrent.timestamp.desc()).limit(10).all()
+    def nearest(self, lat, lng, count, radius=None):
+        """距离最近的 count 台设备（可限定半径，米），返回 (距离, device_id, 位置字典) 列表"""
+        self._refresh()
+        row, col = self._cell(lat, lng)
+        found = []  # (距离, device_id, 位置字典)
+        with self._lock:
+            for ring, cells in self._rings(row, col):
+                # 该圈之前已扫描区域的内切圆半径：圈内及更远的设备都不会比它近
+                covered = self._covered_radius(lat, lng, row, col, ring - 1) if ring else 0
+                if radius is not None and covered > radius:
+                    break
+                if len(found) >= count and found[-1][0] <= covered:
+                    break
+                
+                candidates = [(device_id, self._positions[device_id][1])
+                              for cell in cells for device_id in self._grid[cell]]
+                if not candidates:
+                    continue
+                distances = calculate_distances(
+                    [lat] * len(candidates), [lng] * len(candidates),
+                    [position['latitude'] for _, position in candidates],
+                    [position['longitude'] for _, position in candidates]
+                )
+                found.extend(
+                    (distance, device_id, position)
+                    for distance, (device_id, position) in zip(distances, candidates)
+                    if radius is None or distance <= radius
+                )
+                found = heapq.nsmallest(count, found, key=lambda item: item[0])
+        return found
     
-    return render_template('admin/dashboard.html', stats=stats, recent_locations=recent_locations)
+    def stats(self):
+        with self._lock:
+            return {'devices': len(self._positions), 'cells': len(self._grid)}
 
-# ==================== GPS数据API ====================
+position_index = PositionIndex(
+    cell_size=app.config['POSITION_INDEX_CELL_SIZE'],
+    reload_seconds=app.config['POSITION_INDEX_RELOAD_SECONDS']
+)
 
-@app.route('/api/gps/upload', methods=['POST'])
-def upload_gps_data():
-    """设备上传GPS数据"""
+# ==================== GPS数据写入 ====================
+
+# 每设备保留的实时位置条数
+MAX_CURRENT_LOCATIONS = 10
+# 防抖距离阈值（米）
+DEBOUNCE_DISTANCE = 50
+
+def _optional_float(value):
+    """可选数值字段转为float，无效值视为缺失"""
+    if value is None:
+        return None
     try:
-        data = request.get_json()
-        device_id = data.get('device_id')
-        locations = data.get('locations', [])
-        
-        if not device_id or not locations:
-            return jsonify({'error': '缺少必要参数'}), 400
-        
-        # 验证设备是否存在
-        device = Device.query.filter_by(device_id=device_id).first()
-        if not device:
-            return jsonify({'error': '设备不存在'}), 404
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+def parse_locations(locations):
+    """解析上传的位置列表，丢弃无效点，按时间排序"""
+    points = []
+    now = datetime.utcnow()
+    for loc_data in locations:
+        if not isinstance(loc_data, dict):
+            continue
+        lat = loc_data.get('latitude')
+        lng = loc_data.get('longitude')
+        if not lat or not lng:
+            continue
         
-        # 处理位置数据
-        processed_count = 0
-        for loc_data in locations:
-            lat = loc_data.get('latitude')
-            lng = loc_data.get('longitude')
-            timestamp = datetime.fromisoformat(loc_data.get('timestamp', datetime.utcnow().isoformat()))
-            
-            if not lat or not lng:
-                continue
-            
-            # 检查是否为重复位置（防抖）
-            last_location = LocationCurrent.query.filter_by(device_id=device_id).order_by(LocationCurrent.timestamp.desc()).first()
-            if last_location and is_same_location(lat, lng, last_location.latitude, last_location.longitude):
+        try:
+            timestamp = loc_data.get('timestamp')
+            points.append(GPSPoint(
+                latitude=float(lat),
+                longitude=float(lng),
+                altitude=_optional_float(loc_data.get('altitude')),
+                accuracy=_optional_float(loc_data.get('accuracy')),
+                speed=_optional_float(loc_data.get('speed')),
+                heading=_optional_float(loc_data.get('heading')),
+                timestamp=parse_timestamp(timestamp) if timestamp else now
+            ))
+        except (TypeError, ValueError):
+            continue
+    
+    points.sort(key=lambda p: p.timestamp)
+    return points
+
+def debounce_points(points, last_point=None, threshold=DEBOUNCE_DISTANCE):
+    """批量防抖：每个点与上一个已接收的点比较，距离小于阈值则丢弃"""
+    if not points:
+        return []
+    
+    sin, cos = math.sin, math.cos
+    # 预先批量换算弧度和纬度余弦，并把距离阈值换算成半正矢值，逐点比较时只剩几次乘加
+    phis = [math.radians(p.latitude) for p in points]
+    lams = [math.radians(p.longitude) for p in points]
+    cos_phis = [cos(phi) for phi in phis]
+    hav_threshold = sin(threshold / (2 * 6371000)) ** 2
+    
+    if last_point is not None:
+        ref_phi = math.radians(last_point.latitude)
+        ref_lam = math.radians(last_point.longitude)
+        ref_cos = cos(ref_phi)
+    
+    accepted = []
+    for i, point in enumerate(points):
+        if last_point is not None or accepted:
+            hav = (sin((phis[i] - ref_phi) / 2) ** 2 +
+                   ref_cos * cos_phis[i] * sin((lams[i] - ref_lam) / 2) ** 2)
+            if hav < hav_threshold:
                 continue
-            
-            # 保存位置数据
-            location = LocationCurrent(
-                device_id=device_id,
-                latitude=lat,
-                longitude=lng,
-                altitude=loc_data.get('altitude'),
-                accuracy=loc_data.get('accuracy'),
-                speed=loc_data.get('speed'),
-                heading=loc_data.get('heading'),
-                timestamp=timestamp
+        accepted.append(point)
+        ref_phi, ref_lam, ref_cos = phis[i], lams[i], cos_phis[i]
+    return accepted
+
+def begin_write_transaction(conn):
+    """显式开启SQLite写事务：pysqlite 只在第一条写语句前才隐式 BEGIN，
+    在此之前执行的 SAVEPOINT 会自成事务，RELEASE 时直接提交"""
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+def store_device_points(conn, device_id, points, after_commit):
+    """写入单个设备的一批位置：一次查询最后位置，一条批量插入，返回接收的点；
+    需在事务提交后执行的处理追加到 after_commit，由调用方提交后用 run_after_commit 执行"""
+    table = LocationCurrent.__table__
+    last_point = conn.execute(
+        db.select(table.c.latitude, table.c.longitude, table.c.timestamp)
+        .where(table.c.device_id == device_id)
+        .order_by(table.c.timestamp.desc())
+        .limit(1)
+    ).first()
+    
+    accepted = debounce_points(points, last_point)
+    if not accepted:
+        return accepted
+    
+    # 速度只算一次，每日统计与超速检测共用同一个前序点
+    speeds = calculate_speeds(accepted, last_point)
+    update_daily_stats(conn, device_id, accepted, speeds, last_point)
+    
+    # 每设备只保留最新10条由后台压缩任务批量裁剪
+    conn.execute(table.insert(), [dict(point._asdict(), device_id=device_id) for point in accepted])
+    
+    archive_device_points(conn, device_id, accepted)
+    geofence_engine.evaluate(conn, device_id, accepted, after_commit)
+    # 超速状态只在数据提交后推进，回滚的点不会计入
+    after_commit.append(lambda: overspeed_detector.evaluate(device_id, accepted, speeds))
+    return accepted
+
+def run_after_commit(callbacks):
+    """执行提交后的处理，单个出错不影响其他"""
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"提交后处理失败: {e}")
+
+def track_window_start(timestamp):
+    """时间所属归档窗口的起点"""
+    window = app.config['TRACK_SEGMENT_SECONDS']
+    seconds = int((timestamp - TRACK_EPOCH).total_seconds())
+    return TRACK_EPOCH + timedelta(seconds=seconds - seconds % window)
+
+def archive_device_points(conn, device_id, points):
+    """把已接收的点追加到对应时间窗口的轨迹段"""
+    table = TrackSegment.__table__
+    by_window = {}
+    for point in points:
+        by_window.setdefault(track_window_start(point.timestamp), []).append(point)
+    
+    existing = {
+        row.window_start: row
+        for row in conn.execute(
+            db.select(table.c.id, table.c.window_start, table.c.end_time, table.c.last_latitude, table.c.last_longitude)
+            .where(table.c.device_id == device_id, table.c.window_start.in_(list(by_window)))
+        )
+    }
+    
+    for window_start, window_points in by_window.items():
+        row = existing.get(window_start)
+        if row and row.last_latitude is not None and window_points[0].timestamp >= row.end_time:
+            # 新点都在段内最后一个点之后（常见情况）：只在末尾拼接新点的记录
+            previous = (int((row.end_time - TRACK_EPOCH).total_seconds()), row.last_latitude, row.last_longitude)
+            chunk, last = encode_track_chunk(window_points, previous)
+            conn.execute(table.update().where(table.c.id == row.id).values(
+                data=db.cast(table.c.data.concat(chunk), db.LargeBinary),
+                end_time=window_points[-1].timestamp,
+                point_count=table.c.point_count + len(window_points),
+                last_latitude=last[1],
+                last_longitude=last[2]
+            ))
+            continue
+        
+        if row:
+            # 乱序补传或旧格式的段：解码合并后整段重写
+            data = conn.execute(db.select(table.c.data).where(table.c.id == row.id)).scalar()
+            window_points = sorted(decode_track_points(data) + window_points, key=lambda p: p.timestamp)
+        data, last = encode_track_chunk(window_points)
+        values = {
+            'start_time': window_points[0].timestamp,
+            'end_time': window_points[-1].timestamp,
+            'point_count': len(window_points),
+            'data': data,
+            'last_latitude': last[1],
+            'last_longitude': last[2]
+        }
+        if row:
+            conn.execute(table.update().where(table.c.id == row.id).values(**values))
+        else:
+            conn.execute(table.insert().values(device_id=device_id, window_start=window_start, **values))
+
+def iter_track_points(device_id, start=None, end=None, resolution=0):
+    """按时间顺序逐段解码与时间范围重叠的轨迹段；resolution 非0时读取对应的降采样层"""
+    if resolution:
+        table = TrackRollup.__table__
+        query = db.select(table.c.data).where(table.c.device_id == device_id, table.c.resolution == resolution)
+    else:
+        table = TrackSegment.__table__
+        query = db.select(table.c.data).where(table.c.device_id == device_id)
+    if start:
+        query = query.where(table.c.end_time >= start)
+    if end:
+        query = query.where(table.c.start_time <= end)
+    
+    with location_shards.engine(device_id).connect() as conn:
+        for row in conn.execute(query.order_by(table.c.start_time)):
+            for point in decode_track_points(row.data):
+                if (start and point.timestamp < start) or (end and point.timestamp > end):
+                    continue
+                yield point
+
+# 降采样层（分桶秒数, 轨迹段窗口秒数），从细到粗
+ROLLUP_TIERS = ((60, 86400), (600, 7 * 86400))
+
+# 历史查询按时间跨度自动选择精度：不超过1天用原始点，不超过31天用1分钟，更长用10分钟
+HISTORY_RESOLUTIONS = ((timedelta(days=1), 0), (timedelta(days=31), 60))
+
+def choose_history_resolution(start, end):
+    """按查询跨度选择精度（秒）；未指定起点时返回原始点"""
+    if start is None:
+        return 0
+    span = (end or datetime.utcnow()) - start
+    for max_span, resolution in HISTORY_RESOLUTIONS:
+        if span <= max_span:
+            return resolution
+    return ROLLUP_TIERS[-1][0]
+
+def downsample_points(points, resolution):
+    """按 resolution 秒分桶，每桶保留最后一个点（真实上报的位置，不做平均）"""
+    bucket = last = None
+    for point in points:
+        current = int((point.timestamp - TRACK_EPOCH).total_seconds()) // resolution
+        if last is not None and current != bucket:
+            yield last
+        bucket, last = current, point
+    if last is not None:
+        yield last
+
+def iter_history_points(device_id, start=None, end=None, resolution=0):
+    """合并原始层与各降采样层（数据已按时间迁移到不同层），再降到所需精度"""
+    layers = [iter_track_points(device_id, start, end)]
+    layers += [iter_track_points(device_id, start, end, tier) for tier, _ in ROLLUP_TIERS]
+    points = heapq.merge(*layers, key=lambda point: point.timestamp)
+    return downsample_points(points, resolution) if resolution else points
+
+class IngestQueue:
+    """异步写入队列：请求线程只做校验和入队，后台线程把多个设备的数据合并到一个事务提交
+
+    每个位置分片一个队列和一个写入线程，各分片并行提交
+    """
+    
+    def __init__(self, maxsize, batch_points, max_wait, shards=1):
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(max(1, shards))]
+        self.batch_points = batch_points
+        self.max_wait = max_wait
+        self._threads = []
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'enqueued_uploads': 0,
+            'rejected_uploads': 0,
+            'committed_batches': 0,
+            'accepted_points': 0,
+            'dropped_points': 0,
+            'failed_batches': 0,
+            'failed_uploads': 0,
+            'last_batch_uploads': 0,
+            'last_batch_points': 0,
+            'last_commit_ms': 0.0,
+            'avg_commit_ms': 0.0,
+            'max_queue_wait_ms': 0.0,
+        }
+    
+    def start(self):
+        """启动后台写入线程（每个分片一个）"""
+        if self._threads and all(thread.is_alive() for thread in self._threads):
+            return
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._run, args=(index,), name=f'gps-ingest-writer-{index}', daemon=True)
+            for index in range(len(self.queues))
+        ]
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.stop)
+        logger.info(f"GPS异步写入线程已启动: {len(self._threads)} 个")
+    
+    def submit(self, device_id, points):
+        """入队，所在分片的队列已满时抛出 queue.Full"""
+        try:
+            self.queues[location_shards.index(device_id)].put_nowait((device_id, points, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.stats['rejected_uploads'] += 1
+            raise
+        with self._stats_lock:
+            self.stats['enqueued_uploads'] += 1
+    
+    def stop(self, timeout=10):
+        """停止写入线程并把队列中剩余数据全部提交"""
+        self._stopping.set()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join(timeout)
+        for index, q in enumerate(self.queues):
+            while not q.empty():
+                for items in self._split_by_device(self._take_batch(q, block=False)):
+                    self._commit(index, items)
+    
+    def _run(self, index):
+        q = self.queues[index]
+        while not self._stopping.is_set():
+            for items in self._split_by_device(self._take_batch(q, block=True)):
+                self._commit(index, items)
+    
+    def _take_batch(self, q, block):
+        """取一批数据：等到第一条后，在 max_wait 内继续合并，直到点数达到 batch_points"""
+        items = []
+        point_count = 0
+        try:
+            first = q.get(timeout=0.5) if block else q.get_nowait()
+        except queue.Empty:
+            return items
+        items.append(first)
+        point_count += len(first[1])
+        
+        deadline = time.monotonic() + self.max_wait
+        while point_count < self.batch_points:
+            remaining = deadline - time.monotonic()
+            try:
+                item = q.get(timeout=remaining) if block and remaining > 0 else q.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            point_count += len(item[1])
+        return items
+    
+    @staticmethod
+    def _split_by_device(items):
+        """同一设备在一批里出现多次时拆成多个事务按顺序提交：围栏等按设备的状态在提交后才更新，
+        同一事务里的后一次上传会读到旧状态"""
+        batches = []
+        seen = {}
+        for item in items:
+            n = seen.get(item[0], 0)
+            seen[item[0]] = n + 1
+            if n == len(batches):
+                batches.append([])
+            batches[n].append(item)
+        return batches
+    
+    def _commit(self, index, items):
+        if not items:
+            return
+        started = time.monotonic()
+        point_count = sum(len(points) for _, points, _ in items)
+        with app.app_context():
+            try:
+                accepted_count = 0
+                failed_uploads = 0
+                failed_points = 0
+                latest = {}
+                after_commit = []
+                with location_shards.engines()[index].begin() as conn:
+                    begin_write_transaction(conn)
+                    for device_id, points, _ in items:
+                        # 每次上传一个保存点：单次上传出错只丢弃这一次，不影响同批其他设备
+                        item_after_commit = []
+                        try:
+                            with conn.begin_nested():
+                                accepted = store_device_points(conn, device_id, points, item_after_commit)
+                        except Exception as e:
+                            logger.error(f"GPS数据写入失败，已丢弃设备 {device_id} 的 {len(points)} 个点: {e}")
+                            failed_uploads += 1
+                            failed_points += len(points)
+                            continue
+                        after_commit.extend(item_after_commit)
+                        accepted_count += len(accepted)
+                        if accepted and (device_id not in latest or accepted[-1].timestamp >= latest[device_id].timestamp):
+                            latest[device_id] = accepted[-1]
+                
+                metrics.inc('gps_ingest_points_total', accepted_count, stage='stored')
+                metrics.inc('gps_ingest_points_total', point_count - failed_points - accepted_count, stage='debounced')
+                metrics.inc('gps_ingest_points_total', failed_points, stage='failed')
+                run_after_commit(after_commit)
+                publish_positions({device_id: position_to_dict(point) for device_id, point in latest.items()})
+            except Exception as e:
+                logger.error(f"GPS批量提交失败(分片{index}): {e}")
+                with self._stats_lock:
+                    self.stats['failed_batches'] += 1
+                return
+        
+        finished = time.monotonic()
+        commit_ms = (finished - started) * 1000
+        with self._stats_lock:
+            stats = self.stats
+            stats['committed_batches'] += 1
+            stats['accepted_points'] += accepted_count
+            stats['dropped_points'] += point_count - accepted_count
+            stats['failed_uploads'] += failed_uploads
+            stats['last_batch_uploads'] = len(items)
+            stats['last_batch_points'] = point_count
+            stats['last_commit_ms'] = commit_ms
+            stats['avg_commit_ms'] = commit_ms if stats['committed_batches'] == 1 else stats['avg_commit_ms'] * 0.9 + commit_ms * 0.1
+            stats['max_queue_wait_ms'] = max(stats['max_queue_wait_ms'], (finished - min(item[2] for item in items)) * 1000)
+    
+    def get_stats(self):
+        """队列深度、批大小与提交耗时"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = sum(q.qsize() for q in self.queues)
+        stats['queue_capacity'] = sum(q.maxsize for q in self.queues)
+        stats['shard_queue_depth'] = [q.qsize() for q in self.queues]
+        stats['batch_points'] = self.batch_points
+        stats['running'] = bool(self._threads) and all(thread.is_alive() for thread in self._threads)
+        return stats
+
+ingest_queue = IngestQueue(
+    maxsize=app.config['INGEST_QUEUE_SIZE'],
+    batch_points=app.config['INGEST_BATCH_POINTS'],
+    max_wait=app.config['INGEST_MAX_WAIT'],
+    shards=location_shards.count
+)
+metrics.gauge('gps_ingest_queue_depth', lambda: {(): ingest_queue.get_stats()['queue_depth']})
+
+# ==================== 电子围栏 ====================
+
+def _parse_coordinate(item):
+    """解析单个坐标：支持 {"lat","lng"}、{"latitude","longitude"} 和 [lat, lng]"""
+    if isinstance(item, dict):
+        lat = item.get('lat', item.get('latitude'))
+        lng = item.get('lng', item.get('lon', item.get('longitude')))
+    else:
+        lat, lng = item[0], item[1]
+    return float(lat), float(lng)
+
+def parse_fence_coordinates(text):
+    """解析围栏坐标JSON，返回 [(lat, lng), ...]"""
+    data = json.loads(text)
+    if isinstance(data, dict) or (isinstance(data, list) and data and isinstance(data[0], (int, float))):
+        return [_parse_coordinate(data)]
+    return [_parse_coordinate(item) for item in data]
+
+def point_in_polygon(lat, lng, lats, lngs):
+    """射线法判断点是否在多边形内"""
+    inside = False
+    j = len(lats) - 1
+    for i in range(len(lats)):
+        if (lats[i] > lat) != (lats[j] > lat) and \
+                lng < (lngs[j] - lngs[i]) * (lat - lats[i]) / (lats[j] - lats[i]) + lngs[i]:
+            inside = not inside
+        j = i
+    return inside
+
+class FenceShape:
+    """预解析的围栏几何"""
+    __slots__ = ('id', 'fence_type', 'device_ids', 'min_lat', 'min_lng', 'max_lat', 'max_lng',
+                 'center_lat', 'center_lng', 'radius', 'lats', 'lngs')
+    
+    def __init__(self, fence):
+        self.id = fence.id
+        self.fence_type = fence.fence_type
+        device_ids = json.loads(fence.device_ids) if fence.device_ids else None
+        self.device_ids = frozenset(device_ids) if device_ids else None  # None 表示适用所有设备
+        
+        coordinates = parse_fence_coordinates(fence.coordinates)
+        if fence.fence_type == 'circle':
+            self.center_lat, self.center_lng = coordinates[0]
+            self.radius = float(fence.radius or 0)
+            dlat = self.radius / 111320
+            dlng = self.radius / (111320 * max(math.cos(math.radians(self.center_lat)), 0.01))
+            self.min_lat, self.max_lat = self.center_lat - dlat, self.center_lat + dlat
+            self.min_lng, self.max_lng = self.center_lng - dlng, self.center_lng + dlng
+        else:
+            if len(coordinates) < 3:
+                raise ValueError('多边形围栏至少需要3个顶点')
+            self.lats = [lat for lat, _ in coordinates]
+            self.lngs = [lng for _, lng in coordinates]
+            self.min_lat, self.max_lat = min(self.lats), max(self.lats)
+            self.min_lng, self.max_lng = min(self.lngs), max(self.lngs)
+    
+    def contains(self, lat, lng):
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lng <= lng <= self.max_lng):
+            return False
+        if self.fence_type == 'circle':
+            return calculate_distance(lat, lng, self.center_lat, self.center_lng) <= self.radius
+        return point_in_polygon(lat, lng, self.lats, self.lngs)
+
+class GeofenceEngine:
+    """围栏判定引擎：围栏预解析后放入网格索引，每个点只与所在网格内的围栏比较"""
+    
+    REDIS_STATE_KEY = 'gps:fence_state'
+    # 覆盖网格数超过该值的大围栏不进网格，单独用外接矩形预筛
+    MAX_FENCE_CELLS = 400
+    
+    def __init__(self, cell_size, reload_seconds):
+        self.cell_size = cell_size
+        self.reload_seconds = reload_seconds
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._dirty = set()
+        self.fences = {}  # fence_id -> FenceShape
+        self.grid = {}  # (行, 列) -> {fence_id}
+        self.large_fences = set()
+        self.global_fences = set()  # 适用所有设备的围栏
+        self.device_fences = {}  # device_id -> {fence_id}
+        # device_id -> 当前所在围栏（无Redis时）。各工作进程各自一份：同一设备的上传落到不同进程时，
+        # 进程间状态不一致会产生重复的进出事件，多进程部署请启用Redis
+        self._state = {}
+    
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+    
+    def _cells(self, shape):
+        min_row, min_col = self._cell(shape.min_lat, shape.min_lng)
+        max_row, max_col = self._cell(shape.max_lat, shape.max_lng)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > self.MAX_FENCE_CELLS:
+            return None
+        return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+    
+    def _add(self, shape):
+        self.fences[shape.id] = shape
+        cells = self._cells(shape)
+        if cells is None:
+            self.large_fences.add(shape.id)
+        else:
+            for cell in cells:
+                self.grid.setdefault(cell, set()).add(shape.id)
+        if shape.device_ids is None:
+            self.global_fences.add(shape.id)
+        else:
+            for device_id in shape.device_ids:
+                self.device_fences.setdefault(device_id, set()).add(shape.id)
+    
+    def _remove(self, fence_id):
+        shape = self.fences.pop(fence_id, None)
+        if not shape:
+            return
+        self.large_fences.discard(fence_id)
+        for cell in self._cells(shape) or []:
+            fences = self.grid.get(cell)
+            if fences:
+                fences.discard(fence_id)
+                if not fences:
+                    del self.grid[cell]
+        self.global_fences.discard(fence_id)
+        for device_id in shape.device_ids or []:
+            fences = self.device_fences.get(device_id)
+            if fences:
+                fences.discard(fence_id)
+                if not fences:
+                    del self.device_fences[device_id]
+    
+    def _load_shape(self, fence):
+        try:
+            return FenceShape(fence)
+        except (TypeError, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"围栏 {fence.id} 坐标无效，已忽略: {e}")
+            return None
+    
+    def load(self):
+        """全量加载启用的围栏并重建索引"""
+        fences = ElectronicFence.query.filter_by(is_active=True).all()
+        with self._lock:
+            self.fences, self.grid, self.device_fences = {}, {}, {}
+            self.large_fences, self.global_fences = set(), set()
+            for fence in fences:
+                shape = self._load_shape(fence)
+                if shape:
+                    self._add(shape)
+            self._dirty.clear()
+            self._loaded_at = time.monotonic()
+        logger.info(f"电子围栏加载完成: {len(self.fences)} 个")
+    
+    def mark_dirty(self, fence_id):
+        """围栏被修改，下次判定前增量重建"""
+        with self._lock:
+            self._dirty.add(fence_id)
+    
+    def _refresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.reload_seconds:
+            self.load()
+            return
+        if not self._dirty:
+            return
+        
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        fences = {fence.id: fence for fence in ElectronicFence.query.filter(ElectronicFence.id.in_(dirty)).all()}
+        with self._lock:
+            for fence_id in dirty:
+                self._remove(fence_id)
+                fence = fences.get(fence_id)
+                if fence and fence.is_active:
+                    shape = self._load_shape(fence)
+                    if shape:
+                        self._add(shape)
+    
+    def _get_state(self, conn, device_id):
+        if REDIS_AVAILABLE:
+            try:
+                value = redis_client.hget(self.REDIS_STATE_KEY, device_id)
+                if value is not None:
+                    return set(json.loads(value))
+            except redis.RedisError as e:
+                logger.warning(f"读取围栏状态失败: {e}")
+        elif device_id in self._state:
+            return set(self._state[device_id])
+        
+        # 首次遇到该设备：以每个围栏最后一次进出事件恢复状态
+        table = AlarmEvent.__table__
+        last_ids = (db.select(db.func.max(table.c.id))
+                    .where(table.c.device_id == device_id, table.c.event_type.in_(('fence_enter', 'fence_exit')))
+                    .group_by(table.c.fence_id))
+        rows = conn.execute(db.select(table.c.fence_id).where(table.c.id.in_(last_ids), table.c.event_type == 'fence_enter'))
+        return {row.fence_id for row in rows}
+    
+    def _set_state(self, device_id, inside):
+        if REDIS_AVAILABLE:
+            try:
+                redis_client.hset(self.REDIS_STATE_KEY, device_id, json.dumps(sorted(inside)))
+                return
+            except redis.RedisError as e:
+                logger.warning(f"写入围栏状态失败: {e}")
+        self._state[device_id] = frozenset(inside)
+    
+    def evaluate(self, conn, device_id, points, after_commit):
+        """逐点判定进出围栏，写入报警事件并返回事件列表；所在围栏状态在事务提交后才更新"""
+        self._refresh()
+        with self._lock:
+            applicable = self.device_fences.get(device_id, set()) | self.global_fences
+        if not applicable or not points:
+            return []
+        
+        previous = self._get_state(conn, device_id)
+        events = []
+        with self._lock:
+            inside = previous & set(self.fences)
+            for point in points:
+                lat, lng = point.latitude, point.longitude
+                candidates = (self.grid.get(self._cell(lat, lng), set()) | self.large_fences) & applicable
+                now_inside = {fence_id for fence_id in candidates if self.fences[fence_id].contains(lat, lng)}
+                for event_type, fence_ids in (('fence_enter', now_inside - inside), ('fence_exit', inside - now_inside)):
+                    for fence_id in fence_ids:
+                        events.append({
+                            'device_id': device_id,
+                            'event_type': event_type,
+                            'fence_id': fence_id,
+                            'latitude': lat,
+                            'longitude': lng,
+                            'speed': point.speed,
+                            'event_time': point.timestamp
+                        })
+                inside = now_inside
+        
+        if events:
+            conn.execute(AlarmEvent.__table__.insert(), events)
+        if inside != previous:
+            # 上传被回滚时进出事件一并丢弃，状态也不能前移，否则下次上传看不到这次进出
+            after_commit.append(lambda: self._set_state(device_id, inside))
+        return events
+
+geofence_engine = GeofenceEngine(
+    cell_size=app.config['GEOFENCE_CELL_SIZE'],
+    reload_seconds=app.config['GEOFENCE_RELOAD_SECONDS']
+)
+
+@event.listens_for(ElectronicFence, 'after_insert')
+@event.listens_for(ElectronicFence, 'after_update')
+@event.listens_for(ElectronicFence, 'after_delete')
+def on_fence_changed(mapper, connection, target):
+    """围栏增删改：先记在会话上，提交后再通知引擎增量重建（提交前重建会读到旧数据）"""
+    session = object_session(target)
+    if session is None:
+        geofence_engine.mark_dirty(target.id)
+        return
+    session.info.setdefault('changed_fences', set()).add(target.id)
+
+@event.listens_for(db.session, 'after_commit')
+def on_fence_session_commit(session):
+    for fence_id in session.info.pop('changed_fences', ()):
+        geofence_engine.mark_dirty(fence_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def on_fence_session_rollback(session):
+    session.info.pop('changed_fences', None)
+
+# ==================== 超速检测 ====================
+
+class SpeedState:
+    """单个设备的超速检测状态"""
+    __slots__ = ('lock', 'over_count', 'in_overspeed')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.over_count = 0
+        self.in_overspeed = False
+
+class OverspeedDetector:
+    """流式超速检测：状态保存在内存，连续超速达到次数才报警，回落到限速以下一定幅度才结束本次超速"""
+    
+    TRIGGER_POINTS = 2  # 连续超速点数
+    RELEASE_MARGIN = 5  # 低于 限速-5km/h 才视为恢复
+    
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+    
+    def get_speed_limit(self, device_id):
+        """当前设备限速（km/h），未启用超速检测时返回None"""
+        if not get_system_config('speed_limit_enabled', True):
+            return None
+        limit = get_system_config('default_speed_limit', 60)
+        if get_system_config('dynamic_speed_limit', False):
+            # 动态限速：按设备单独配置的限速覆盖默认值
+            overrides = get_system_config('speed_limit_overrides', {})
+            if isinstance(overrides, dict):
+                limit = overrides.get(device_id, limit)
+        try:
+            return float(limit)
+        except (TypeError, ValueError):
+            return None
+    
+    def evaluate(self, device_id, points, speeds):
+        """检测一批已提交的点（speeds 为入库时算出的速度），写入超速报警并返回事件列表"""
+        if not points:
+            return []
+        with self._lock:
+            state = self._states.get(device_id)
+            if state is None:
+                state = self._states[device_id] = SpeedState()
+        
+        limit = self.get_speed_limit(device_id)
+        if limit is None:
+            return []
+        
+        events = []
+        with state.lock:
+            for point, speed in zip(points, speeds):
+                if speed > limit:
+                    state.over_count += 1
+                    if not state.in_overspeed and state.over_count >= self.TRIGGER_POINTS:
+                        state.in_overspeed = True
+                        events.append({
+                            'device_id': device_id,
+                            'event_type': 'overspeed',
+                            'latitude': point.latitude,
+                            'longitude': point.longitude,
+                            'speed': round(speed, 1),
+                            'event_time': point.timestamp
+                        })
+                elif speed < limit - self.RELEASE_MARGIN:
+                    state.over_count = 0
+                    state.in_overspeed = False
+        
+        if events:
+            with location_shards.engine(device_id).begin() as conn:
+                conn.execute(AlarmEvent.__table__.insert(), events)
+        return events
+
+overspeed_detector = OverspeedDetector()
+
+# ==================== 里程统计与常去地点 ====================
+
+# 两点间隔超过该时长且平均速度很低视为一次停车
+STOP_MIN_SECONDS = 300
+STOP_MAX_SPEED = 5  # km/h
+PLACE_GEOHASH_PRECISION = 7  # 约150米网格
+
+def update_daily_stats(conn, device_id, points, speeds, last_point=None):
+    """按新接收的点增量更新每日统计，检测到的停车点计入常去地点"""
+    chain = ([last_point] if last_point is not None else []) + list(points)
+    distances = calculate_distances(
+        [p.latitude for p in chain[:-1]], [p.longitude for p in chain[:-1]],
+        [p.latitude for p in chain[1:]], [p.longitude for p in chain[1:]]
+    )
+    offset = len(chain) - len(points)
+    
+    daily = {}
+    stops = []
+    for i, point in enumerate(points):
+        day = daily.setdefault(point.timestamp.date(), {
+            'distance': 0.0, 'moving_seconds': 0, 'max_speed': 0.0, 'stop_count': 0, 'point_count': 0
+        })
+        day['point_count'] += 1
+        day['max_speed'] = max(day['max_speed'], speeds[i])
+        
+        j = i + offset
+        if j == 0:
+            continue
+        previous = chain[j - 1]
+        seconds = (point.timestamp - previous.timestamp).total_seconds()
+        if seconds <= 0:
+            continue
+        
+        distance = distances[j - 1]
+        day['distance'] += distance
+        if seconds >= STOP_MIN_SECONDS and distance / seconds * 3.6 < STOP_MAX_SPEED:
+            day['stop_count'] += 1
+            stops.append((previous, int(seconds)))
+        else:
+            day['moving_seconds'] += int(seconds)
+    
+    now = datetime.utcnow()
+    table = DeviceDailyStats.__table__
+    for stat_date, values in daily.items():
+        stmt = sqlite_insert(table).values(device_id=device_id, stat_date=stat_date, updated_at=now, **values)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=['device_id', 'stat_date'],
+            set_={
+                'distance': table.c.distance + stmt.excluded.distance,
+                'moving_seconds': table.c.moving_seconds + stmt.excluded.moving_seconds,
+                'max_speed': db.func.max(table.c.max_speed, stmt.excluded.max_speed),
+                'stop_count': table.c.stop_count + stmt.excluded.stop_count,
+                'point_count': table.c.point_count + stmt.excluded.point_count,
+                'updated_at': now
+            }
+        ))
+    
+    table = FrequentPlace.__table__
+    for stop, dwell_seconds in stops:
+        stmt = sqlite_insert(table).values(
+            device_id=device_id,
+            geohash=encode_geohash(stop.latitude, stop.longitude, PLACE_GEOHASH_PRECISION),
+            latitude=stop.latitude,
+            longitude=stop.longitude,
+            visit_count=1,
+            total_dwell_seconds=dwell_seconds,
+            first_visit=stop.timestamp,
+            last_visit=stop.timestamp
+        )
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=['device_id', 'geohash'],
+            set_={
+                'latitude': (table.c.latitude * table.c.visit_count + stmt.excluded.latitude) / (table.c.visit_count + 1),
+                'longitude': (table.c.longitude * table.c.visit_count + stmt.excluded.longitude) / (table.c.visit_count + 1),
+                'visit_count': table.c.visit_count + 1,
+                'total_dwell_seconds': table.c.total_dwell_seconds + stmt.excluded.total_dwell_seconds,
+                'last_visit': db.func.max(table.c.last_visit, stmt.excluded.last_visit)
+            }
+        ))
+
+# ==================== 存储监控 ====================
+
+class StorageMonitor:
+    """后台定时采样磁盘使用率，超过阈值时发送告警邮件（去重并带冷却时间）"""
+    
+    REDIS_ALERT_KEY = 'gps:storage_alert'
+    
+    def __init__(self, interval, alert_cooldown):
+        self.interval = interval
+        self.alert_cooldown = alert_cooldown
+        self._usage = None
+        self._last_alert = None
+        self._thread = None
+        self._stopping = threading.Event()
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='storage-monitor', daemon=True)
+        self._thread.start()
+        atexit.register(self._stopping.set)
+    
+    def get_usage(self):
+        """最近一次采样结果，尚未采样时立即采样"""
+        if self._usage is None:
+            self.sample()
+        return self._usage
+    
+    def sample(self):
+        self._usage = dict(check_storage_usage(), checked_at=datetime.utcnow().isoformat())
+        return self._usage
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with app.app_context():
+                    self.check()
+            except Exception as e:
+                logger.error(f"存储检查失败: {e}")
+            self._stopping.wait(self.interval)
+    
+    def check(self):
+        """采样并在超过阈值时告警"""
+        usage = self.sample()
+        try:
+            threshold = float(get_system_config('storage_alert_threshold', 80))
+        except (TypeError, ValueError):
+            threshold = 80
+        if usage['usage_percent'] > threshold and self._claim_alert():
+            logger.warning(f"磁盘使用率 {usage['usage_percent']:.1f}% 超过阈值 {threshold:g}%")
+            send_storage_alert(usage)
+    
+    def _claim_alert(self):
+        """冷却期内只允许发送一次；有Redis时所有工作进程共享冷却状态"""
+        if REDIS_AVAILABLE:
+            try:
+                return bool(redis_client.set(self.REDIS_ALERT_KEY, os.getpid(), nx=True, ex=self.alert_cooldown))
+            except redis.RedisError as e:
+                logger.warning(f"读取告警冷却状态失败: {e}")
+        now = time.monotonic()
+        if self._last_alert is not None and now - self._last_alert < self.alert_cooldown:
+            return False
+        self._last_alert = now
+        return True
+
+storage_monitor = StorageMonitor(
+    interval=app.config['STORAGE_CHECK_INTERVAL'],
+    alert_cooldown=app.config['STORAGE_ALERT_COOLDOWN']
+)
+
+# ==================== 数据保留与降采样 ====================
+
+class RetentionCompactor:
+    """后台数据保留任务：裁剪实时位置表，把过期的原始轨迹降采样为1分钟层、
+    1分钟层再降为10分钟层，删除超过保留期的10分钟层。每个事务只处理一小批记录，
+    事务之间停顿，避免长时间占用SQLite写锁。多个工作进程中只有持有文件锁的一个执行"""
+    
+    def __init__(self, interval, trim_interval, batch_size, batch_pause):
+        self.interval = interval
+        self.trim_interval = trim_interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock_file = None
+        self._compacted_at = 0
+        self.stats = {'trimmed': 0, 'rolled_up': 0, 'purged': 0, 'last_run': None}
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='retention-compactor', daemon=True)
+        self._thread.start()
+        atexit.register(self._stopping.set)
+    
+    def _claim(self):
+        """获取跨进程文件锁，进程退出时自动释放"""
+        if self._lock_file is not None:
+            return True
+        directory = app.config['LOCATION_SHARD_DIR']
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'retention.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info(f"数据保留任务由进程 {os.getpid()} 执行")
+        return True
+    
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self._claim():
+                    with app.app_context():
+                        self.run_once()
+            except Exception as e:
+                logger.error(f"数据保留任务失败: {e}")
+            self._stopping.wait(self.trim_interval)
+    
+    def run_once(self, force=False):
+        """裁剪实时位置表；距上次压缩超过 interval 时执行降采样与过期删除"""
+        for engine in location_shards.engines():
+            self.trim_current(engine)
+        
+        if not force and time.monotonic() - self._compacted_at < self.interval:
+            return
+        self._compacted_at = time.monotonic()
+        now = datetime.utcnow()
+        config = app.config
+        cutoffs = (now - timedelta(days=config['RETENTION_RAW_DAYS']), now - timedelta(days=config['RETENTION_1M_DAYS']))
+        for engine in location_shards.engines():
+            source_resolution = 0
+            for (resolution, window_seconds), cutoff in zip(ROLLUP_TIERS, cutoffs):
+                self.roll_up(engine, source_resolution, resolution, window_seconds, cutoff)
+                source_resolution = resolution
+            if config['RETENTION_10M_DAYS'] > 0:
+                self.purge(engine, source_resolution, now - timedelta(days=config['RETENTION_10M_DAYS']))
+        self.stats['last_run'] = now.isoformat()
+    
+    def _record(self, action, count):
+        if count:
+            self.stats[action] += count
+            metrics.inc('gps_retention_rows_total', count, action=action)
+    
+    def _pause(self):
+        self._stopping.wait(self.batch_pause)
+    
+    def trim_current(self, engine):
+        """每设备只保留最新 MAX_CURRENT_LOCATIONS 条实时位置"""
+        table = LocationCurrent.__table__
+        with engine.connect() as conn:
+            device_ids = [row.device_id for row in conn.execute(
+                db.select(table.c.device_id).group_by(table.c.device_id)
+                .having(db.func.count() > MAX_CURRENT_LOCATIONS)
+            )]
+        
+        for i in range(0, len(device_ids), self.batch_size):
+            ranked = db.select(
+                table.c.id,
+                db.func.row_number().over(
+                    partition_by=table.c.device_id,
+                    order_by=(table.c.timestamp.desc(), table.c.id.desc())
+                ).label('position')
+            ).where(table.c.device_id.in_(device_ids[i:i + self.batch_size])).subquery()
+            with engine.begin() as conn:
+                deleted = conn.execute(table.delete().where(
+                    table.c.id.in_(db.select(ranked.c.id).where(ranked.c.position > MAX_CURRENT_LOCATIONS))
+                )).rowcount
+            self._record('trimmed', deleted)
+            self._pause()
+    
+    def roll_up(self, engine, source_resolution, resolution, window_seconds, cutoff):
+        """把结束时间早于 cutoff 的源层轨迹段降采样并入目标层，随后删除源记录"""
+        source = TrackRollup.__table__ if source_resolution else TrackSegment.__table__
+        rollup = TrackRollup.__table__
+        while not self._stopping.is_set():
+            query = db.select(source.c.id, source.c.device_id, source.c.data).where(source.c.end_time < cutoff)
+            if source_resolution:
+                query = query.where(source.c.resolution == source_resolution)
+            with engine.begin() as conn:
+                rows = conn.execute(query.order_by(source.c.id).limit(self.batch_size)).all()
+                if not rows:
+                    return
+                
+                grouped = {}
+                for row in rows:
+                    for point in decode_track_points(row.data):
+                        seconds = int((point.timestamp - TRACK_EPOCH).total_seconds())
+                        window_start = TRACK_EPOCH + timedelta(seconds=seconds - seconds % window_seconds)
+                        grouped.setdefault((row.device_id, window_start), []).append(point)
+                
+                existing = {
+                    (row.device_id, row.window_start): row
+                    for row in conn.execute(
+                        db.select(rollup.c.id, rollup.c.device_id, rollup.c.window_start, rollup.c.data).where(
+                            rollup.c.resolution == resolution,
+                            rollup.c.device_id.in_({device_id for device_id, _ in grouped}),
+                            rollup.c.window_start.in_({window_start for _, window_start in grouped})
+                        )
+                    )
+                }
+                for (device_id, window_start), points in grouped.items():
+                    row = existing.get((device_id, window_start))
+                    if row:
+                        points = points + decode_track_points(row.data)
+                    points = list(downsample_points(sorted(points, key=lambda p: p.timestamp), resolution))
+                    values = {
+                        'start_time': points[0].timestamp,
+                        'end_time': points[-1].timestamp,
+                        'point_count': len(points),
+                        'data': encode_track_points(points)
+                    }
+                    if row:
+                        conn.execute(rollup.update().where(rollup.c.id == row.id).values(**values))
+                    else:
+                        conn.execute(rollup.insert().values(
+                            device_id=device_id, resolution=resolution, window_start=window_start, **values
+                        ))
+                conn.execute(source.delete().where(source.c.id.in_([row.id for row in rows])))
+            self._record('rolled_up', len(rows))
+            self._pause()
+    
+    def purge(self, engine, resolution, cutoff):
+        """分批删除结束时间早于 cutoff 的降采样轨迹段"""
+        table = TrackRollup.__table__
+        while not self._stopping.is_set():
+            with engine.begin() as conn:
+                ids = [row.id for row in conn.execute(
+                    db.select(table.c.id)
+                    .where(table.c.resolution == resolution, table.c.end_time < cutoff)
+                    .limit(self.batch_size)
+                )]
+                if not ids:
+                    return
+                conn.execute(table.delete().where(table.c.id.in_(ids)))
+            self._record('purged', len(ids))
+            self._pause()
+
+retention_compactor = RetentionCompactor(
+    interval=app.config['RETENTION_INTERVAL'],
+    trim_interval=app.config['RETENTION_TRIM_INTERVAL'],
+    batch_size=app.config['RETENTION_BATCH_SIZE'],
+    batch_pause=app.config['RETENTION_BATCH_PAUSE']
+)
+
+# ==================== 设备注册表 ====================
+
+class DeviceRecord:
+    """注册表中的设备记录"""
+    __slots__ = ('device_id', 'status', 'last_seen', 'dirty')
+    
+    def __init__(self, device_id, status, last_seen):
+        self.device_id = device_id
+        self.status = status
+        self.last_seen = last_seen
+        self.dirty = False
+
+class DeviceRegistry:
+    """设备注册表：上传鉴权只查内存；在线状态和最后在线时间在内存中更新，由后台线程批量写回"""
+    
+    NEGATIVE_TTL = 30  # 不存在的设备ID缓存时间（秒），避免未知设备反复查库
+    
+    def __init__(self, flush_interval, reload_interval):
+        self.flush_interval = flush_interval
+        self.reload_interval = reload_interval
+        # 设备被新增、修改或删除时递增，其他进程在下一次写回时发现并重新加载
+        self.version = VersionCounter('devices')
+        self._loaded_version = None
+        self._records = {}
+        self._unknown = {}  # device_id -> 过期时间
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._thread = None
+        self._stopping = threading.Event()
+    
+    def load(self):
+        """从数据库全量加载；本进程尚未写回的在线状态保留，数据库中的禁用状态优先"""
+        table = Device.__table__
+        version = self.version.get()
+        rows = db.session.execute(db.select(table.c.device_id, table.c.status, table.c.last_seen)).all()
+        with self._lock:
+            records = {}
+            for row in rows:
+                record = self._records.get(row.device_id)
+                if record and record.dirty and row.status != 'disabled':
+                    records[row.device_id] = record
+                    continue
+                records[row.device_id] = DeviceRecord(row.device_id, row.status, row.last_seen)
+            self._records = records
+            self._dirty &= set(records)
+            self._unknown.clear()
+            self._loaded_at = time.monotonic()
+            self._loaded_version = version
+        logger.info(f"设备注册表加载完成: {len(rows)} 台设备")
+    
+    def lookup(self, device_id):
+        """查找设备记录，不存在返回None"""
+        record = self._records.get(device_id)
+        if record is not None:
+            return record
+        
+        # 其他进程新增的设备：查一次库并缓存结果
+        now = time.monotonic()
+        if self._unknown.get(device_id, 0) > now:
+            return None
+        table = Device.__table__
+        row = db.session.execute(
+            db.select(table.c.device_id, table.c.status, table.c.last_seen).where(table.c.device_id == device_id)
+        ).first()
+        with self._lock:
+            if row is None:
+                if len(self._unknown) > 10000:
+                    self._unknown.clear()
+                self._unknown[device_id] = now + self.NEGATIVE_TTL
+                return None
+            record = self._records.setdefault(device_id, DeviceRecord(row.device_id, row.status, row.last_seen))
+        return record
+    
+    def touch(self, device_id, seen_at=None):
+        """设备上报：标记在线并更新最后在线时间"""
+        record = self._records.get(device_id)
+        if record is None or record.status == 'disabled':
+            return
+        came_online = presence_tracker.touch(device_id)
+        with self._lock:
+            record.status = 'online'
+            record.last_seen = seen_at or datetime.utcnow()
+            record.dirty = True
+            self._dirty.add(device_id)
+        if came_online:
+            location_broker.publish({'type': 'status', 'device_id': device_id, 'status': 'online'})
+    
+    def mark_offline(self, device_ids):
+        """标记设备离线，返回状态实际发生变化的设备"""
+        changed = []
+        with self._lock:
+            for device_id in device_ids:
+                record = self._records.get(device_id)
+                if record is None or record.status == 'disabled':
+                    continue
+                if record.status != 'offline':
+                    changed.append(device_id)
+                record.status = 'offline'
+                record.dirty = True
+                self._dirty.add(device_id)
+        return changed
+    
+    def online_devices(self):
+        """状态为在线的设备及其最后在线时间"""
+        with self._lock:
+            return [(r.device_id, r.last_seen) for r in self._records.values() if r.status == 'online']
+    
+    def apply(self, changes):
+        """合并已提交的设备变更：device_id -> 变更的字段，None 表示已删除。
+        只覆盖变更的字段，最后在线时间取较新值，尚未写回的在线状态不会丢失"""
+        with self._lock:
+            for device_id, fields in changes.items():
+                if fields is None:
+                    self._records.pop(device_id, None)
+                    self._dirty.discard(device_id)
+                    continue
+                self._unknown.pop(device_id, None)
+                record = self._records.get(device_id)
+                if record is None:
+                    self._records[device_id] = DeviceRecord(device_id, fields.get('status'), fields.get('last_seen'))
+                    continue
+                if 'status' in fields:
+                    record.status = fields['status']
+                last_seen = fields.get('last_seen')
+                if last_seen is not None and (record.last_seen is None or last_seen > record.last_seen):
+                    record.last_seen = last_seen
+    
+    def flush(self):
+        """把变化的状态一次批量写回数据库"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            params = []
+            for device_id in dirty:
+                record = self._records.get(device_id)
+                if record is None:
+                    continue
+                record.dirty = False
+                params.append({'b_device_id': device_id, 'b_status': record.status, 'b_last_seen': record.last_seen})
+        if not params:
+            return 0
+        
+        table = Device.__table__
+        try:
+            # 禁用状态以数据库为准，不被在线状态覆盖
+            db.session.execute(
+                table.update()
+                .where(table.c.device_id == db.bindparam('b_device_id'), table.c.status != 'disabled')
+                .values(status=db.bindparam('b_status'), last_seen=db.bindparam('b_last_seen')),
+                params
             )
-            db.session.add(location)
-            processed_count += 1
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"设备状态写回失败: {e}")
+            with self._lock:
+                self._dirty.update(p['b_device_id'] for p in params)
+            return 0
+        return len(params)
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='device-registry', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+    
+    def stop(self):
+        self._stopping.set()
+        with app.app_context():
+            self.flush()
+    
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                with app.app_context():
+                    self.flush()
+                    if (self._loaded_at is None or time.monotonic() - self._loaded_at > self.reload_interval
+                            or self.version.get() != self._loaded_version):
+                        self.load()
+            except Exception as e:
+                logger.error(f"设备注册表后台任务失败: {e}")
+
+device_registry = DeviceRegistry(
+    flush_interval=app.config['DEVICE_FLUSH_INTERVAL'],
+    reload_interval=app.config['DEVICE_RELOAD_INTERVAL']
+)
+
+def queue_device_change(connection, target, fields):
+    """设备增删改：先记在会话上，提交后再合并到注册表（回滚的修改不生效），并通知其他进程重新加载"""
+    session = object_session(target)
+    if session is None:
+        device_registry.apply({target.device_id: fields})
+        return
+    session.info.setdefault('changed_devices', {})[target.device_id] = fields
+    device_registry.version.bump_on_commit(session, connection)
+
+@event.listens_for(Device, 'after_insert')
+def on_device_inserted(mapper, connection, target):
+    queue_device_change(connection, target, {'status': target.status, 'last_seen': target.last_seen})
+
+@event.listens_for(Device, 'after_update')
+def on_device_updated(mapper, connection, target):
+    # 只合并本次修改的字段，其余字段以注册表中的为准
+    state = inspect(target)
+    fields = {key: getattr(target, key) for key in ('status', 'last_seen') if state.attrs[key].history.has_changes()}
+    queue_device_change(connection, target, fields)
+
+@event.listens_for(Device, 'after_delete')
+def on_device_deleted(mapper, connection, target):
+    queue_device_change(connection, target, None)
+
+@event.listens_for(db.session, 'after_commit')
+def on_device_session_commit(session):
+    changes = session.info.pop('changed_devices', None)
+    if changes:
+        device_registry.apply(changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def on_device_session_rollback(session):
+    session.info.pop('changed_devices', None)
+
+# ==================== 在线状态 ====================
+
+class PresenceTracker:
+    """在线状态跟踪：设备到期时间放在按秒分桶的时间轮里，检查离线只处理到期的桶，
+    与设备总数无关；Redis可用时改用有序集合，多个工作进程共享同一份状态"""
+    
+    REDIS_KEY = 'gps:presence'
+    
+    # 原子地取出并删除已超时的设备，保证每台设备只被一个工作进程处理
+    EXPIRE_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    if #expired > 0 then
+        redis.call('ZREM', KEYS[1], unpack(expired))
+    end
+    return expired
+    """
+    
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._wheel = {}  # 到期时间（整秒）-> {device_id}
+        self._deadlines = {}  # device_id -> 到期时间（整秒）
+        self._swept_until = int(time.time())
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._expire_script = redis_client.register_script(self.EXPIRE_SCRIPT) if REDIS_AVAILABLE else None
+    
+    @property
+    def timeout(self):
+        try:
+            return float(get_system_config('device_offline_timeout', 300))
+        except (TypeError, ValueError):
+            return 300.0
+    
+    def touch(self, device_id, seen_at=None):
+        """记录设备上报，返回该设备此前是否不在跟踪中（即刚上线）"""
+        seen_at = seen_at or time.time()
+        if REDIS_AVAILABLE:
+            try:
+                return redis_client.zadd(self.REDIS_KEY, {device_id: seen_at}) == 1
+            except redis.RedisError as e:
+                logger.warning(f"更新在线状态失败: {e}")
+        
+        with self._lock:
+            # 已经过期的设备放到下一个待检查的桶
+            deadline = max(int(seen_at + self.timeout) + 1, self._swept_until + 1)
+            previous = self._deadlines.get(device_id)
+            if previous == deadline:
+                return False
+            if previous is not None:
+                bucket = self._wheel.get(previous)
+                if bucket:
+                    bucket.discard(device_id)
+                    if not bucket:
+                        del self._wheel[previous]
+            self._deadlines[device_id] = deadline
+            self._wheel.setdefault(deadline, set()).add(device_id)
+        return previous is None
+    
+    def seed(self, devices):
+        """启动时登记数据库中仍为在线的设备（device_id, last_seen），已在跟踪中的不覆盖"""
+        now = datetime.utcnow()
+        for device_id, last_seen in devices:
+            age = (now - last_seen).total_seconds() if last_seen else self.timeout
+            seen_at = time.time() - max(age, 0)
+            if REDIS_AVAILABLE:
+                try:
+                    redis_client.zadd(self.REDIS_KEY, {device_id: seen_at}, nx=True)
+                    continue
+                except redis.RedisError as e:
+                    logger.warning(f"登记在线状态失败: {e}")
+            if device_id not in self._deadlines:
+                self.touch(device_id, seen_at)
+    
+    def expire(self, limit=1000):
+        """取出已超时的设备"""
+        now = time.time()
+        if REDIS_AVAILABLE:
+            try:
+                return self._expire_script(keys=[self.REDIS_KEY], args=[now - self.timeout, limit])
+            except redis.RedisError as e:
+                logger.warning(f"检查在线状态失败: {e}")
+        
+        expired = []
+        now_tick = int(now)
+        with self._lock:
+            for tick in range(self._swept_until + 1, now_tick + 1):
+                for device_id in self._wheel.pop(tick, ()):
+                    self._deadlines.pop(device_id, None)
+                    expired.append(device_id)
+            self._swept_until = max(self._swept_until, now_tick)
+        
+        if expired:
+            # 无Redis时其他工作进程的上报本进程看不到，以数据库中（已写回的）最后在线时间复核
+            table = Device.__table__
+            cutoff = datetime.utcnow() - timedelta(seconds=self.timeout)
+            rows = db.session.execute(
+                db.select(table.c.device_id, table.c.last_seen)
+                .where(table.c.device_id.in_(expired), table.c.last_seen > cutoff)
+            ).all()
+            for row in rows:
+                self.touch(row.device_id, now - (datetime.utcnow() - row.last_seen).total_seconds())
+            recent = {row.device_id for row in rows}
+            expired = [device_id for device_id in expired if device_id not in recent]
+        return expired
+    
+    def check(self):
+        """把超时的设备标记为离线，批量写回并推送离线事件"""
+        expired = self.expire()
+        if not expired:
+            return []
+        changed = device_registry.mark_offline(expired)
+        if changed:
+            device_registry.flush()
+            for device_id in changed:
+                location_broker.publish({'type': 'status', 'device_id': device_id, 'status': 'offline'})
+            logger.info(f"{len(changed)} 台设备超时离线")
+        return changed
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='presence-tracker', daemon=True)
+        self._thread.start()
+        atexit.register(self._stopping.set)
+    
+    def _run(self):
+        while not self._stopping.wait(self.check_interval):
+            try:
+                with app.app_context():
+                    self.check()
+            except Exception as e:
+                logger.error(f"在线状态检查失败: {e}")
+
+presence_tracker = PresenceTracker(check_interval=app.config['PRESENCE_CHECK_INTERVAL'])
+
+# ==================== 软件授权清单 ====================
+
+class PermissionManifestCache:
+    """设备软件授权清单：版本号变化时一次查询重建全部设备的清单，读取走内存；
+    清单按内容计算ETag，内容不变的设备始终返回相同ETag"""
+    
+    def __init__(self, check_interval, signing_key):
+        self.check_interval = check_interval
+        self.signing_key = signing_key.encode('utf-8') if signing_key else None
+        self.version = VersionCounter('permissions')
+        self._manifests = None  # device_id -> (ETag, 响应体, 失效时间)
+        self._loaded_version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+    
+    def _query(self, device_ids=None):
+        """已授权、未过期且软件启用的授权记录"""
+        permission = DeviceAppPermission.__table__
+        software = Software.__table__
+        query = (db.select(permission.c.device_id, permission.c.expires_at,
+                           software.c.app_package, software.c.app_name, software.c.version)
+                 .join(software, software.c.id == permission.c.software_id)
+                 .where(permission.c.is_authorized == True, software.c.is_active == True,
+                        db.or_(permission.c.expires_at.is_(None), permission.c.expires_at > datetime.utcnow()))
+                 .order_by(permission.c.device_id, software.c.app_package))
+        if device_ids is not None:
+            query = query.where(permission.c.device_id.in_(device_ids))
+        return db.session.execute(query).all()
+    
+    def _build(self, device_id, rows):
+        # 同一软件有多条授权时取最晚到期的一条（无到期时间视为永久）
+        latest = {}
+        for row in rows:
+            current = latest.get(row.app_package)
+            if current is None or (row.expires_at or datetime.max) > (current.expires_at or datetime.max):
+                latest[row.app_package] = row
+        expiries = [row.expires_at for row in latest.values() if row.expires_at]
+        valid_until = min(expiries) if expiries else None
+        
+        manifest = {
+            'device_id': device_id,
+            'packages': [{
+                'app_package': row.app_package,
+                'app_name': row.app_name,
+                'version': row.version,
+                'expires_at': row.expires_at.isoformat() if row.expires_at else None
+            } for _, row in sorted(latest.items())],
+            'valid_until': valid_until.isoformat() if valid_until else None
+        }
+        canonical = json.dumps(manifest, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        manifest['signature'] = hmac.new(self.signing_key, canonical, hashlib.sha256).hexdigest()
+        etag = hashlib.sha256(canonical).hexdigest()[:32]
+        manifest['manifest_version'] = etag
+        body = json.dumps(manifest, ensure_ascii=False, separators=(',', ':'))
+        return etag, body, valid_until
+    
+    def _ensure_fresh(self):
+        if self._manifests is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._manifests is not None and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            version = self.version.get()
+            if self._manifests is None or version != self._loaded_version:
+                grouped = {}
+                for row in self._query():
+                    grouped.setdefault(row.device_id, []).append(row)
+                self._manifests = {device_id: self._build(device_id, rows) for device_id, rows in grouped.items()}
+                self._loaded_version = version
+                logger.info(f"软件授权清单已重建: {len(self._manifests)} 台设备, 版本 {version}")
+    
+    def get(self, device_id):
+        """返回 (ETag, 响应体)；清单中有授权到期时只重建该设备"""
+        self._ensure_fresh()
+        manifests = self._manifests
+        entry = manifests.get(device_id)
+        if entry is None or (entry[2] is not None and entry[2] <= datetime.utcnow()):
+            entry = self._build(device_id, self._query([device_id]))
+            with self._lock:
+                # 期间清单已整体重建时以新清单为准
+                if self._manifests is manifests:
+                    manifests[device_id] = entry
+        return entry[0], entry[1]
+    
+    def mark_changed(self, session, conn=None):
+        """登记授权数据变更：版本号随本事务递增（见 VersionCounter.bump_on_commit），每个事务只递增一次"""
+        if session.info.get('manifests_changed'):
+            return
+        self.version.bump_on_commit(session, conn)
+        session.info['manifests_changed'] = True
+    
+    def invalidate(self):
+        """下次读取时立即检查版本号"""
+        self._checked_at = 0
+
+permission_manifests = PermissionManifestCache(
+    check_interval=app.config['CONFIG_CHECK_INTERVAL'],
+    signing_key=app.config['MANIFEST_SIGNING_KEY']
+)
+
+@event.listens_for(DeviceAppPermission, 'after_insert')
+@event.listens_for(DeviceAppPermission, 'after_update')
+@event.listens_for(DeviceAppPermission, 'after_delete')
+@event.listens_for(Software, 'after_update')
+@event.listens_for(Software, 'after_delete')
+def on_permission_changed(mapper, connection, target):
+    """授权记录或软件（启用状态、到期时间等）变更后使清单失效"""
+    permission_manifests.mark_changed(object_session(target), connection)
+
+@event.listens_for(db.session, 'after_commit')
+def on_manifest_session_commit(session):
+    if session.info.pop('manifests_changed', False):
+        permission_manifests.invalidate()
+
+@event.listens_for(db.session, 'after_rollback')
+def on_manifest_session_rollback(session):
+    session.info.pop('manifests_changed', None)
+
+# ==================== 后台统计 ====================
+
+# 后台轮询可增量更新的计数项
+DASHBOARD_COUNTERS = ('total_devices', 'online_devices', 'offline_devices', 'total_owners', 'total_software')
+
+class DashboardStats:
+    """管理后台统计快照：过期后由一个线程重算（single-flight），其余请求继续使用旧快照"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = 0
+        self.counters = None
+        self.previous_version = None
+        self.previous_counters = None
+        self.recent_locations = []
+        self._computed_at = 0
+        self._refresh_lock = threading.Lock()
+    
+    def get(self):
+        """返回 (计数, 最近位置)"""
+        if self.counters is None or time.monotonic() - self._computed_at > self.ttl:
+            # 首次必须等待结果；之后若已有线程在重算则直接返回旧快照
+            if self._refresh_lock.acquire(blocking=self.counters is None):
+                try:
+                    if self.counters is None or time.monotonic() - self._computed_at > self.ttl:
+                        self._refresh()
+                finally:
+                    self._refresh_lock.release()
+        return self.counters, self.recent_locations
+    
+    def _refresh(self):
+        device = Device.__table__
+        total_devices, online_devices = db.session.execute(
+            db.select(db.func.count(), db.func.coalesce(db.func.sum(db.case((device.c.status == 'online', 1), else_=0)), 0))
+        ).one()
+        counters = {
+            'total_devices': total_devices,
+            'online_devices': online_devices,
+            'offline_devices': total_devices - online_devices,
+            'total_owners': db.session.execute(db.select(db.func.count()).select_from(VehicleOwner.__table__)).scalar(),
+            'total_software': db.session.execute(
+                db.select(db.func.count()).select_from(Software.__table__).where(Software.__table__.c.is_active == True)
+            ).scalar()
+        }
+        
+        location = LocationCurrent.__table__
+        self.recent_locations = heapq.nlargest(10, location_shards.fetch_all(
+            db.select(location.c.device_id, location.c.latitude, location.c.longitude, location.c.timestamp)
+            .order_by(location.c.timestamp.desc())
+            .limit(10)
+        ), key=lambda row: row.timestamp)
+        
+        if counters != self.counters:
+            self.previous_version, self.previous_counters = self.version, self.counters
+            self.version += 1
+            self.counters = counters
+        self._computed_at = time.monotonic()
+    
+    def delta(self, since_version):
+        """客户端持有 since_version 时需要更新的计数项"""
+        counters, _ = self.get()
+        if since_version == self.version:
+            return {}
+        if since_version is not None and since_version == self.previous_version and self.previous_counters:
+            return {key: value for key, value in counters.items() if self.previous_counters.get(key) != value}
+        return dict(counters)
+
+dashboard_stats = DashboardStats(ttl=app.config['DASHBOARD_STATS_TTL'])
+
+# ==================== 实时推送 ====================
+
+class Subscription:
+    """推送客户端订阅：按设备列表或经纬度范围过滤，缓冲有界，满了丢弃最旧的消息"""
+    
+    def __init__(self, buffer_size, device_ids=None, bbox=None):
+        self.device_ids = frozenset(device_ids) if device_ids else None
+        self.bbox = bbox  # (min_lat, min_lng, max_lat, max_lng)
+        self.buffer = deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._condition = threading.Condition()
+    
+    def matches(self, message):
+        if self.device_ids is not None and message['device_id'] not in self.device_ids:
+            return False
+        if self.bbox is not None and 'latitude' in message:
+            min_lat, min_lng, max_lat, max_lng = self.bbox
+            return min_lat <= message['latitude'] <= max_lat and min_lng <= message['longitude'] <= max_lng
+        return True
+    
+    def put(self, message):
+        with self._condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(message)
+            self._condition.notify()
+    
+    def get(self, timeout):
+        """等待并取出全部缓冲消息，返回 (消息列表, 丢弃条数)"""
+        with self._condition:
+            if not self.buffer:
+                self._condition.wait(timeout)
+            messages = list(self.buffer)
+            self.buffer.clear()
+            dropped, self.dropped = self.dropped, 0
+        return messages, dropped
+
+class LocationBroker:
+    """位置与状态变化的发布订阅：Redis可用时经 pub/sub 分发到所有工作进程，否则进程内分发"""
+    
+    REDIS_CHANNEL = 'gps:events'
+    
+    def __init__(self, buffer_size, max_clients):
+        self.buffer_size = buffer_size
+        self.max_clients = max_clients
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def subscribe(self, device_ids=None, bbox=None):
+        """新建订阅，连接数已满时返回None"""
+        with self._lock:
+            if len(self._subscriptions) >= self.max_clients:
+                return None
+            subscription = Subscription(self.buffer_size, device_ids, bbox)
+            self._subscriptions.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+    
+    def publish(self, message):
+        if REDIS_AVAILABLE and self._thread:
+            try:
+                redis_client.publish(self.REDIS_CHANNEL, json.dumps(message))
+                return
+            except redis.RedisError as e:
+                logger.warning(f"发布实时消息失败: {e}")
+        self.dispatch(message)
+    
+    def dispatch(self, message):
+        """投递给本进程中匹配的订阅"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.matches(message):
+                subscription.put(message)
+    
+    def start(self):
+        """Redis可用时启动订阅线程，把其他进程发布的消息转发给本进程的客户端"""
+        if not REDIS_AVAILABLE or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._listen, name='location-broker', daemon=True)
+        self._thread.start()
+    
+    def _listen(self):
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.REDIS_CHANNEL)
+                for item in pubsub.listen():
+                    message = json.loads(item['data'])
+                    if message['type'] == 'location':
+                        # 其他进程接收的位置同步到本进程的空间索引
+                        position = {key: value for key, value in message.items() if key not in ('type', 'device_id')}
+                        position_index.update_many({message['device_id']: position})
+                    self.dispatch(message)
+            except Exception as e:
+                logger.error(f"实时消息订阅中断，5秒后重连: {e}")
+                time.sleep(5)
+
+location_broker = LocationBroker(
+    buffer_size=app.config['STREAM_BUFFER_SIZE'],
+    max_clients=app.config['STREAM_MAX_CLIENTS']
+)
+
+def publish_positions(positions):
+    """提交后更新最新位置缓存并推送位置变化（positions: device_id -> 位置字典）"""
+    latest_positions.update_many(positions)
+    position_index.update_many(positions)
+    for device_id, position in positions.items():
+        location_broker.publish(dict(position, type='location', device_id=device_id))
+
+# ==================== 后台任务 ====================
+
+_background_pid = None
+_background_lock = threading.Lock()
+
+def start_background_tasks():
+    """启动后台任务（每个工作进程只启动一次）"""
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+    
+    with app.app_context():
+        config_cache.load()
+        try:
+            device_registry.load()
+            presence_tracker.seed(device_registry.online_devices())
+        except Exception as e:
+            logger.error(f"设备注册表加载失败: {e}")
+        try:
+            latest_positions.warm_up()
+        except Exception as e:
+            logger.error(f"最新位置缓存预热失败: {e}")
+        try:
+            position_index.load()
+        except Exception as e:
+            logger.error(f"位置空间索引加载失败: {e}")
+        try:
+            geofence_engine.load()
+        except Exception as e:
+            logger.error(f"电子围栏加载失败: {e}")
+    
+    metrics.start()
+    storage_monitor.start()
+    retention_compactor.start()
+    device_registry.start()
+    presence_tracker.start()
+    location_broker.start()
+    if app.config['GPS_INGEST_MODE'] == 'async':
+        ingest_queue.start()
+
+@app.before_request
+def ensure_background_tasks():
+    """gunicorn工作进程在处理第一个请求时启动后台任务"""
+    start_background_tasks()
+
+# ==================== 认证装饰器 ====================
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'admin_id' not in session:
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ==================== 路由定义 ====================
+
+@app.route('/')
+def index():
+    """首页重定向到管理后台"""
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """管理员登录"""
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        
+        admin = Admin.query.filter_by(username=username).first()
+        if admin and check_password_hash(admin.password_hash, password):
+            session['admin_id'] = admin.id
+            session['admin_username'] = admin.username
+            admin.last_login = datetime.utcnow()
+            db.session.commit()
+            return redirect(url_for('admin_dashboard'))
+        else:
+            flash('用户名或密码错误', 'error')
+    
+    return render_template('login.html')
+
+@app.route('/logout')
+def logout():
+    """退出登录"""
+    session.clear()
+    return redirect(url_for('login'))
+
+@app.route('/admin/dashboard')
+@login_required
+def admin_dashboard():
+    """管理后台首页"""
+    # 统计数据与最近位置更新（来自统计快照）
+    counters, recent_locations = dashboard_stats.get()
+    stats = dict(counters, storage_info=storage_monitor.get_usage())
+    
+    return render_template('admin/dashboard.html', stats=stats, recent_locations=recent_locations,
+                           stats_version=dashboard_stats.version)
+
+@app.route('/api/dashboard/stats')
+@login_required
+def get_dashboard_stats():
+    """管理后台统计轮询：只返回自 version 以来变化的计数项"""
+    changed = dashboard_stats.delta(request.args.get('version', type=int))
+    return jsonify({
+        'version': dashboard_stats.version,
+        'stats': changed,
+        'storage_info': storage_monitor.get_usage()
+    })
+
+# ==================== GPS数据API ====================
+
+@app.route('/api/gps/upload', methods=['POST'])
+def upload_gps_data():
+    """设备上传GPS数据"""
+    try:
+        # 按 Content-Type / Content-Encoding 选择解码方式：二进制批量格式或JSON，均可gzip压缩
+        try:
+            body = request.get_data(cache=False)
+            if request.content_encoding == 'gzip':
+                body = gunzip_limited(body)
             
-            # 保持每设备最多10条记录
-            device_locations = LocationCurrent.query.filter_by(device_id=device_id).order_by(LocationCurrent.timestamp.desc()).all()
-            if len(device_locations) >= 10:
-                for old_loc in device_locations[9:]:
-                    db.session.delete(old_loc)
+            if request.mimetype == GPS_BATCH_CONTENT_TYPE:
+                device_id, points = decode_gps_batch(body)
+                points.sort(key=lambda p: p.timestamp)
+                received_count = len(points)
+            else:
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    return jsonify({'error': '数据格式错误: 不是有效的JSON'}), 400
+                if not isinstance(data, dict):
+                    return jsonify({'error': '数据格式错误: 请求体应为JSON对象'}), 400
+                device_id = data.get('device_id')
+                locations = data.get('locations', [])
+                if not device_id or not locations:
+                    return jsonify({'error': '缺少必要参数'}), 400
+                if not isinstance(device_id, str) or not isinstance(locations, list):
+                    return jsonify({'error': '数据格式错误: device_id 应为字符串，locations 应为数组'}), 400
+                points = parse_locations(locations)
+                received_count = len(locations)
+        except ValueError as e:
+            # 二进制解码和gzip解压给出的错误说明
+            return jsonify({'error': f'数据格式错误: {e}'}), 400
         
-        # 更新设备状态
-        device.status = 'online'
-        device.last_seen = datetime.utcnow()
+        if not device_id or not received_count:
+            return jsonify({'error': '缺少必要参数'}), 400
         
-        db.session.commit()
+        metrics.inc('gps_ingest_points_total', received_count, stage='received')
+        metrics.inc('gps_ingest_points_total', received_count - len(points), stage='invalid')
+        
+        # 验证设备是否存在（内存注册表，不访问数据库）
+        record = device_registry.lookup(device_id)
+        if not record:
+            return jsonify({'error': '设备不存在'}), 404
+        if record.status == 'disabled':
+            return jsonify({'error': '设备已禁用'}), 403
         
-        # 检查存储使用情况
-        storage_info = check_storage_usage()
-        if storage_info['usage_percent'] > 80:
-            send_storage_alert()
+        if app.config['GPS_INGEST_MODE'] == 'async':
+            if points:
+                try:
+                    ingest_queue.submit(device_id, points)
+                except queue.Full:
+                    metrics.inc('gps_ingest_points_total', len(points), stage='rejected')
+                    response = jsonify({'error': '服务器繁忙，请稍后重试'})
+                    response.headers['Retry-After'] = '1'
+                    return response, 503
+            
+            # 入队成功后再更新设备状态（内存中更新，定期批量写回），被拒绝的上传不算在线
+            device_registry.touch(device_id)
+            return jsonify({
+                'status': 'queued',
+                'queued_count': len(points),
+                'dropped_count': received_count - len(points),
+                'timestamp': datetime.utcnow().isoformat()
+            }), 202
+        
+        after_commit = []
+        with location_shards.engine(device_id).begin() as conn:
+            accepted = store_device_points(conn, device_id, points, after_commit)
+        run_after_commit(after_commit)
+        # 提交成功后再更新设备状态（内存中更新，定期批量写回）
+        device_registry.touch(device_id)
+        metrics.inc('gps_ingest_points_total', len(accepted), stage='stored')
+        metrics.inc('gps_ingest_points_total', len(points) - len(accepted), stage='debounced')
+        if accepted:
+            publish_positions({device_id: position_to_dict(accepted[-1])})
         
         return jsonify({
             'status': 'success',
-            'processed_count': processed_count,
+            'processed_count': len(accepted),
+            'accepted_count': len(accepted),
+            'dropped_count': received_count - len(accepted),
             'timestamp': datetime.utcnow().isoformat()
         })
         
@@ -421,20 +3601,11 @@ def upload_gps_data():
 def get_device_location(device_id):
     """获取设备当前位置"""
     try:
-        location = LocationCurrent.query.filter_by(device_id=device_id).order_by(LocationCurrent.timestamp.desc()).first()
-        if not location:
+        position = latest_positions.get_or_load_many([device_id]).get(device_id)
+        if not position:
             return jsonify({'error': '设备位置不存在'}), 404
         
-        return jsonify({
-            'device_id': device_id,
-            'latitude': location.latitude,
-            'longitude': location.longitude,
-            'altitude': location.altitude,
-            'accuracy': location.accuracy,
-            'speed': location.speed,
-            'heading': location.heading,
-            'timestamp': location.timestamp.isoformat()
-        })
+        return jsonify(dict(position, device_id=device_id))
     except Exception as e:
         logger.error(f"获取设备位置失败: {e}")
         return jsonify({'error': '服务器内部错误'}), 500
@@ -446,84 +3617,617 @@ def get_device_history(device_id):
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        query = LocationCurrent.query.filter_by(device_id=device_id)
+        start = parse_timestamp(start_date) if start_date else None
+        end = parse_timestamp(end_date) if end_date else None
+        
+        tolerance = request.args.get('tolerance', type=float)
+        max_points = request.args.get('max_points', type=int)
+        zoom = request.args.get('zoom', type=int)
+        resolution = request.args.get('resolution', type=int)
+        if resolution is None:
+            resolution = choose_history_resolution(start, end)
         
-        if start_date:
-            query = query.filter(LocationCurrent.timestamp >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(LocationCurrent.timestamp <= datetime.fromisoformat(end_date))
+        points = iter_history_points(device_id, start, end, resolution)
+        first = next(points, None)
+        if first is None:
+            # 归档启用前的数据只存在于实时位置表
+            table = LocationCurrent.__table__
+            query = db.select(table).where(table.c.device_id == device_id)
+            if start:
+                query = query.where(table.c.timestamp >= start)
+            if end:
+                query = query.where(table.c.timestamp <= end)
+            with location_shards.engine(device_id).connect() as conn:
+                points = iter(conn.execute(query.order_by(table.c.timestamp.asc())).all())
+        else:
+            points = itertools.chain([first], points)
         
-        locations = query.order_by(LocationCurrent.timestamp.asc()).all()
+        simplified = bool(tolerance or max_points or zoom is not None)
+        if simplified:
+            points = simplify_track(points, tolerance, max_points, zoom)
         
-        history = []
-        for loc in locations:
-            history.append({
+        def point_to_dict(loc):
+            return {
                 'latitude': loc.latitude,
                 'longitude': loc.longitude,
                 'altitude': loc.altitude,
                 'speed': loc.speed,
                 'timestamp': loc.timestamp.isoformat()
-            })
+            }
+        
+        # 流式输出：每行一个点，读取一段输出一段
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                for loc in points:
+                    yield json.dumps(point_to_dict(loc), separators=(',', ':')) + '\n'
+            response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        
+        history = [point_to_dict(loc) for loc in points]
         
         return jsonify({
             'device_id': device_id,
             'history': history,
-            'total_points': len(history)
+            'total_points': len(history),
+            'simplified': simplified,
+            'resolution': resolution
         })
     except Exception as e:
         logger.error(f"获取历史轨迹失败: {e}")
         return jsonify({'error': '服务器内部错误'}), 500
 
+@app.route('/api/gps/ingest/stats')
+@login_required
+def get_ingest_stats():
+    """获取异步写入队列状态"""
+    stats = ingest_queue.get_stats()
+    stats['mode'] = app.config['GPS_INGEST_MODE']
+    return jsonify(stats)
+
+@app.route('/api/devices/<device_id>/alarms')
+@login_required
+def get_device_alarms(device_id):
+    """获取设备报警事件"""
+    try:
+        table = AlarmEvent.__table__
+        query = db.select(table).where(table.c.device_id == device_id)
+        event_type = request.args.get('type')
+        if event_type:
+            query = query.where(table.c.event_type == event_type)
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        
+        with location_shards.engine(device_id).connect() as conn:
+            events = conn.execute(query.order_by(table.c.event_time.desc()).limit(limit)).all()
+        return jsonify({
+            'device_id': device_id,
+            'alarms': [{
+                'event_type': e.event_type,
+                'fence_id': e.fence_id,
+                'latitude': e.latitude,
+                'longitude': e.longitude,
+                'speed': e.speed,
+                'event_time': e.event_time.isoformat()
+            } for e in events]
+        })
+    except Exception as e:
+        logger.error(f"获取报警事件失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+def daily_stats_to_dict(row):
+    return {
+        'date': row.stat_date.isoformat(),
+        'distance_km': round(row.distance / 1000, 3),
+        'moving_seconds': row.moving_seconds,
+        'max_speed': round(row.max_speed, 1),
+        'stop_count': row.stop_count,
+        'point_count': row.point_count
+    }
+
+@app.route('/api/devices/<device_id>/mileage')
+@login_required
+def get_device_mileage(device_id):
+    """获取设备每日里程统计"""
+    try:
+        end_date = request.args.get('end_date')
+        start_date = request.args.get('start_date')
+        end = datetime.fromisoformat(end_date).date() if end_date else datetime.utcnow().date()
+        start = datetime.fromisoformat(start_date).date() if start_date else end - timedelta(days=29)
+        
+        table = DeviceDailyStats.__table__
+        with location_shards.engine(device_id).connect() as conn:
+            rows = conn.execute(db.select(table).where(
+                table.c.device_id == device_id,
+                table.c.stat_date >= start,
+                table.c.stat_date <= end
+            ).order_by(table.c.stat_date.asc())).all()
+        
+        return jsonify({
+            'device_id': device_id,
+            'daily': [daily_stats_to_dict(row) for row in rows],
+            'total_distance_km': round(sum(row.distance for row in rows) / 1000, 3),
+            'total_moving_seconds': sum(row.moving_seconds for row in rows)
+        })
+    except Exception as e:
+        logger.error(f"获取里程统计失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+@app.route('/api/devices/<device_id>/places')
+@login_required
+def get_device_places(device_id):
+    """获取设备常去地点"""
+    try:
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        table = FrequentPlace.__table__
+        with location_shards.engine(device_id).connect() as conn:
+            places = conn.execute(db.select(table).where(table.c.device_id == device_id).order_by(
+                table.c.visit_count.desc(), table.c.total_dwell_seconds.desc()
+            ).limit(limit)).all()
+        
+        return jsonify({
+            'device_id': device_id,
+            'places': [{
+                'geohash': place.geohash,
+                'latitude': place.latitude,
+                'longitude': place.longitude,
+                'visit_count': place.visit_count,
+                'total_dwell_seconds': place.total_dwell_seconds,
+                'first_visit': place.first_visit.isoformat() if place.first_visit else None,
+                'last_visit': place.last_visit.isoformat() if place.last_visit else None
+            } for place in places]
+        })
+    except Exception as e:
+        logger.error(f"获取常去地点失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+@app.route('/api/stats/mileage')
+@login_required
+def get_fleet_mileage():
+    """获取全部设备某日里程统计"""
+    try:
+        stat_date = request.args.get('date')
+        day = datetime.fromisoformat(stat_date).date() if stat_date else datetime.utcnow().date()
+        
+        table = DeviceDailyStats.__table__
+        rows = sorted(
+            location_shards.fetch_all(db.select(table).where(table.c.stat_date == day)),
+            key=lambda row: row.distance, reverse=True
+        )
+        return jsonify({
+            'date': day.isoformat(),
+            'devices': [dict(daily_stats_to_dict(row), device_id=row.device_id) for row in rows],
+            'active_devices': len(rows),
+            'total_distance_km': round(sum(row.distance for row in rows) / 1000, 3),
+            'total_stop_count': sum(row.stop_count for row in rows)
+        })
+    except Exception as e:
+        logger.error(f"获取车队里程统计失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+@app.route('/api/stream/locations')
+@login_required
+def stream_locations():
+    """实时推送设备位置与状态变化（Server-Sent Events）
+
+    可选参数：device_ids=A,B 只订阅指定设备；bbox=最小纬度,最小经度,最大纬度,最大经度 只推送范围内的位置
+    """
+    device_ids = [d for d in request.args.get('device_ids', '').split(',') if d] or None
+    bbox = None
+    if request.args.get('bbox'):
+        try:
+            bbox = tuple(float(v) for v in request.args['bbox'].split(','))
+            if len(bbox) != 4:
+                raise ValueError
+        except ValueError:
+            return jsonify({'error': 'bbox格式应为 最小纬度,最小经度,最大纬度,最大经度'}), 400
+    
+    subscription = location_broker.subscribe(device_ids, bbox)
+    if subscription is None:
+        return jsonify({'error': '推送连接数已满，请稍后重试'}), 503
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                messages, dropped = subscription.get(timeout=15)
+                if dropped:
+                    # 客户端消费过慢，提示其重新拉取全量数据
+                    yield f'event: overflow\ndata: {json.dumps({"dropped": dropped})}\n\n'
+                if not messages:
+                    yield ': keepalive\n\n'
+                for message in messages:
+                    yield f"event: {message['type']}\ndata: {json.dumps(message, separators=(',', ':'))}\n\n"
+        finally:
+            location_broker.unsubscribe(subscription)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+MAX_NEARBY_DEVICES = 500
+MAX_BBOX_DEVICES = 20000
+
+def spatial_results_to_dicts(results, status=None):
+    """附加设备状态；已删除的设备从索引中剔除，status 不为空时只保留该状态"""
+    devices = []
+    for item in results:
+        device_id, position = item[-2], item[-1]
+        record = device_registry.lookup(device_id)
+        if record is None:
+            position_index.remove(device_id)
+            continue
+        if status and record.status != status:
+            continue
+        device = dict(position, device_id=device_id, status=record.status)
+        if len(item) == 3:
+            device['distance'] = round(item[0], 1)
+        devices.append(device)
+    return devices
+
+@app.route('/api/positions/nearby')
+@login_required
+def get_nearby_devices():
+    """查询离指定点最近的设备
+
+    参数：lat、lng；可选 limit（默认10）、radius（米）、status（如 online）
+    """
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        limit = min(int(request.args.get('limit', 10)), MAX_NEARBY_DEVICES)
+        radius = float(request.args['radius']) if request.args.get('radius') else None
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or limit < 1 or (radius is not None and radius <= 0):
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({'error': '参数无效：需要 lat、lng，limit 和 radius 须为正数'}), 400
+    
+    try:
+        status = request.args.get('status')
+        count = limit
+        while True:
+            # 按状态过滤或剔除已删除设备后不足 limit 台时，扩大候选数重查
+            found = position_index.nearest(lat, lng, count, radius)
+            devices = spatial_results_to_dicts(found, status)
+            if len(devices) >= limit or len(found) < count:
+                break
+            count *= 4
+        return jsonify({'devices': devices[:limit], 'count': min(len(devices), limit)})
+    except Exception as e:
+        logger.error(f"查询附近设备失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+@app.route('/api/positions/bbox')
+@login_required
+def get_devices_in_bbox():
+    """查询地图范围内的设备
+
+    参数：bbox=最小纬度,最小经度,最大纬度,最大经度；可选 limit（默认并最多 20000）、status
+    """
+    try:
+        min_lat, min_lng, max_lat, max_lng = (float(v) for v in request.args['bbox'].split(','))
+        limit = min(int(request.args.get('limit', MAX_BBOX_DEVICES)), MAX_BBOX_DEVICES)
+        if min_lat > max_lat or min_lng > max_lng or limit < 1:
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({'error': 'bbox格式应为 最小纬度,最小经度,最大纬度,最大经度'}), 400
+    
+    try:
+        results, truncated = position_index.within_bbox(min_lat, min_lng, max_lat, max_lng, limit)
+        devices = spatial_results_to_dicts(results, request.args.get('status'))
+        return jsonify({'devices': devices, 'count': len(devices), 'truncated': truncated})
+    except Exception as e:
+        logger.error(f"查询范围内设备失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
 # ==================== 设备管理API ====================
 
+# 设备列表可选字段
+DEVICE_FIELDS = ('device_id', 'device_name', 'status', 'last_seen', 'vehicle_plate', 'owner', 'vehicle_model', 'latest_location')
+DEVICE_PAGE_SIZE = 100
+MAX_DEVICE_PAGE_SIZE = 1000
+
+def encode_device_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'after': last_id}).encode()).decode().rstrip('=')
+
+def decode_device_cursor(cursor):
+    """游标解析为上一页最后一个设备的主键，格式错误时抛出 ValueError"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return int(data['after'])
+    except (TypeError, KeyError, binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+
+def build_device_query(args, fields):
+    """按筛选条件与所需字段构造设备列表查询（按主键升序）"""
+    device = Device.__table__
+    owner = VehicleOwner.__table__
+    model = VehicleModel.__table__
+    
+    columns = [device.c.id, device.c.device_id, device.c.device_name, device.c.status,
+               device.c.last_seen, device.c.vehicle_plate]
+    source = device
+    if 'owner' in fields or args.get('owner_phone'):
+        source = source.outerjoin(owner, owner.c.id == device.c.owner_id)
+        columns += [owner.c.id.label('owner_pk'), owner.c.phone_number, owner.c.owner_name]
+    if 'vehicle_model' in fields or args.get('model_code'):
+        source = source.outerjoin(model, model.c.id == device.c.vehicle_model_id)
+        columns += [model.c.id.label('model_pk'), model.c.model_name, model.c.manufacturer]
+    
+    query = db.select(*columns).select_from(source).order_by(device.c.id)
+    if args.get('status'):
+        query = query.where(device.c.status == args['status'])
+    if args.get('model_id'):
+        query = query.where(device.c.vehicle_model_id == int(args['model_id']))
+    if args.get('model_code'):
+        query = query.where(model.c.model_code == args['model_code'])
+    if args.get('owner_phone'):
+        query = query.where(owner.c.phone_number == args['owner_phone'])
+    if args.get('plate_prefix'):
+        # 用范围条件代替 LIKE，才能走 vehicle_plate 上的普通索引
+        prefix = args['plate_prefix']
+        query = query.where(device.c.vehicle_plate >= prefix, device.c.vehicle_plate < prefix + '\uffff')
+    return query
+
+def device_rows_to_dicts(rows, fields):
+    """设备行转字典；需要位置时整页一次批量读取最新位置"""
+    positions = {}
+    if 'latest_location' in fields:
+        positions = latest_positions.get_or_load_many([row.device_id for row in rows])
+    
+    result = []
+    for row in rows:
+        item = {
+            'device_id': row.device_id,
+            'device_name': row.device_name,
+            'status': row.status,
+            'last_seen': row.last_seen.isoformat() if row.last_seen else None,
+            'vehicle_plate': row.vehicle_plate
+        }
+        if 'owner' in fields:
+            item['owner'] = {
+                'phone_number': row.phone_number,
+                'owner_name': row.owner_name
+            } if row.owner_pk else None
+        if 'vehicle_model' in fields:
+            item['vehicle_model'] = {
+                'model_name': row.model_name,
+                'manufacturer': row.manufacturer
+            } if row.model_pk else None
+        if 'latest_location' in fields:
+            location = positions.get(row.device_id)
+            item['latest_location'] = {
+                'latitude': location['latitude'],
+                'longitude': location['longitude'],
+                'timestamp': location['timestamp']
+            } if location else None
+        result.append({key: value for key, value in item.items() if key in fields})
+    return result
+
 @app.route('/api/devices')
 @login_required
 def get_devices():
-    """获取设备列表"""
+    """获取设备列表（键集分页）
+
+    可选参数：cursor 上一页返回的 next_cursor；limit 每页条数；status、model_id、model_code、
+    owner_phone、plate_prefix 筛选；fields=device_id,status,... 只返回指定字段；
+    include_total=true 同时返回符合条件的总数；format=ndjson 逐行流式导出全部结果
+    """
+    try:
+        fields = set(DEVICE_FIELDS)
+        if request.args.get('fields'):
+            fields = {f for f in request.args['fields'].split(',') if f in DEVICE_FIELDS} or {'device_id'}
+        
+        try:
+            query = build_device_query(request.args, fields)
+            after = decode_device_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError:
+            return jsonify({'error': '参数格式错误'}), 400
+        device = Device.__table__
+        
+        # 流式导出：按主键分块读取，每块一次查询加一次位置批量读取
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                last_id = after
+                while True:
+                    chunk_query = query.where(device.c.id > last_id) if last_id is not None else query
+                    rows = db.session.execute(chunk_query.limit(MAX_DEVICE_PAGE_SIZE)).all()
+                    if not rows:
+                        break
+                    for item in device_rows_to_dicts(rows, fields):
+                        yield json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n'
+                    last_id = rows[-1].id
+            response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        
+        limit = max(1, min(request.args.get('limit', DEVICE_PAGE_SIZE, type=int), MAX_DEVICE_PAGE_SIZE))
+        page_query = query.where(device.c.id > after) if after is not None else query
+        rows = db.session.execute(page_query.limit(limit + 1)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        device_list = device_rows_to_dicts(rows, fields)
+        
+        result = {
+            'devices': device_list,
+            'count': len(device_list),
+            'next_cursor': encode_device_cursor(rows[-1].id) if has_more else None
+        }
+        if request.args.get('include_total') in ('1', 'true'):
+            result['total'] = db.session.execute(
+                db.select(db.func.count()).select_from(query.with_only_columns(device.c.id).order_by(None).subquery())
+            ).scalar()
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"获取设备列表失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+@app.route('/api/devices/<device_id>/permissions')
+def get_device_permissions(device_id):
+    """车机获取软件授权清单（带签名），清单未变化时返回304"""
+    try:
+        record = device_registry.lookup(device_id)
+        if not record:
+            return jsonify({'error': '设备不存在'}), 404
+        if record.status == 'disabled':
+            return jsonify({'error': '设备已禁用'}), 403
+        
+        if not permission_manifests.signing_key:
+            return jsonify({'error': '授权清单签名密钥未配置'}), 503
+        
+        etag, body = permission_manifests.get(device_id)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error(f"获取授权清单失败: {e}")
+        return jsonify({'error': '服务器内部错误'}), 500
+
+# 批量授权每条语句处理的设备数（受SQLite参数个数限制）
+PERMISSION_CHUNK_SIZE = 500
+MAX_BULK_DEVICES = 20000
+
+@app.route('/api/permissions/bulk', methods=['POST'])
+@login_required
+def bulk_update_permissions():
+    """批量授权/撤销：多台设备 × 多个软件，在一个事务内完成
+
+    请求体：{"action": "grant"|"revoke", "device_ids": [...], "software_ids": [...] 或 "app_packages": [...],
+            "expires_at": "2025-12-31T00:00:00"（可选，仅授权）, "notes": "..."（可选）}
+    """
     try:
-        devices = db.session.query(Device, VehicleOwner, VehicleModel).outerjoin(VehicleOwner).outerjoin(VehicleModel).all()
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        device_ids = list(dict.fromkeys(d for d in data.get('device_ids') or [] if isinstance(d, str) and d))
+        if action not in ('grant', 'revoke') or not device_ids:
+            return jsonify({'error': '缺少必要参数'}), 400
+        if len(device_ids) > MAX_BULK_DEVICES:
+            return jsonify({'error': f'单次最多 {MAX_BULK_DEVICES} 台设备'}), 400
         
-        device_list = []
-        for device, owner, model in devices:
-            # 获取最新位置
-            latest_location = LocationCurrent.query.filter_by(device_id=device.device_id).order_by(LocationCurrent.timestamp.desc()).first()
+        software = Software.__table__
+        if data.get('app_packages'):
+            packages = set(data['app_packages'])
+            rows = db.session.execute(db.select(software.c.id, software.c.app_package)
+                                      .where(software.c.app_package.in_(packages))).all()
+            missing = packages - {row.app_package for row in rows}
+        else:
+            requested = set(data.get('software_ids') or [])
+            rows = db.session.execute(db.select(software.c.id).where(software.c.id.in_(requested))).all()
+            missing = requested - {row.id for row in rows}
+        if missing or not rows:
+            return jsonify({'error': '软件不存在', 'missing': sorted(missing, key=str)}), 400
+        software_ids = [row.id for row in rows]
+        
+        try:
+            expires_at = parse_timestamp(data['expires_at']) if data.get('expires_at') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': '到期时间格式错误'}), 400
+        
+        device = Device.__table__
+        permission = DeviceAppPermission.__table__
+        now = datetime.utcnow()
+        notes = {'notes': data['notes']} if 'notes' in data else {}
+        known = []
+        updated = inserted = 0
+        for i in range(0, len(device_ids), PERMISSION_CHUNK_SIZE):
+            chunk = device_ids[i:i + PERMISSION_CHUNK_SIZE]
+            chunk = [row.device_id for row in db.session.execute(
+                db.select(device.c.device_id).where(device.c.device_id.in_(chunk))
+            )]
+            if not chunk:
+                continue
+            known.extend(chunk)
+            scope = db.and_(permission.c.device_id.in_(chunk), permission.c.software_id.in_(software_ids))
             
-            device_info = {
-                'device_id': device.device_id,
-                'device_name': device.device_name,
-                'status': device.status,
-                'last_seen': device.last_seen.isoformat() if device.last_seen else None,
-                'vehicle_plate': device.vehicle_plate,
-                'owner': {
-                    'phone_number': owner.phone_number if owner else None,
-                    'owner_name': owner.owner_name if owner else None
-                } if owner else None,
-                'vehicle_model': {
-                    'model_name': model.model_name if model else None,
-                    'manufacturer': model.manufacturer if model else None
-                } if model else None,
-                'latest_location': {
-                    'latitude': latest_location.latitude,
-                    'longitude': latest_location.longitude,
-                    'timestamp': latest_location.timestamp.isoformat()
-                } if latest_location else None
-            }
-            device_list.append(device_info)
+            if action == 'revoke':
+                updated += db.session.execute(
+                    permission.update().where(scope, permission.c.is_authorized == True)
+                    .values(is_authorized=False, **notes)
+                ).rowcount
+                continue
+            
+            existing = set(db.session.execute(db.select(permission.c.device_id, permission.c.software_id).where(scope)).all())
+            if existing:
+                updated += db.session.execute(permission.update().where(scope).values(
+                    is_authorized=True, expires_at=expires_at, authorized_by=session.get('admin_username'),
+                    authorized_at=now, **notes
+                )).rowcount
+            rows = [{
+                'device_id': device_id, 'software_id': software_id, 'is_authorized': True, 'expires_at': expires_at,
+                'authorized_by': session.get('admin_username'), 'authorized_at': now, 'notes': data.get('notes')
+            } for device_id in chunk for software_id in software_ids if (device_id, software_id) not in existing]
+            if rows:
+                db.session.execute(permission.insert(), rows)
+                inserted += len(rows)
+        
+        if updated or inserted:
+            permission_manifests.mark_changed(db.session)
+        db.session.commit()
         
+        known_set = set(known)
         return jsonify({
-            'devices': device_list,
-            'total': len(device_list)
+            'status': 'success',
+            'action': action,
+            'device_count': len(known),
+            'software_count': len(software_ids),
+            'updated_count': updated,
+            'inserted_count': inserted,
+            'unknown_devices': [d for d in device_ids if d not in known_set]
         })
     except Exception as e:
-        logger.error(f"获取设备列表失败: {e}")
+        db.session.rollback()
+        logger.error(f"批量更新授权失败: {e}")
         return jsonify({'error': '服务器内部错误'}), 500
 
+# ==================== 监控接口 ====================
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标（合并所有工作进程）"""
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': '未授权'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics/slow-requests')
+@login_required
+def get_slow_requests():
+    """本工作进程最近的慢请求采样结果"""
+    return jsonify({
+        'enabled': app.config['SLOW_REQUEST_PROFILE_MS'] > 0,
+        'threshold_ms': app.config['SLOW_REQUEST_PROFILE_MS'],
+        'requests': list(slow_request_profiler.recent)
+    })
+
 # ==================== 初始化函数 ====================
 
+def upgrade_table(engine, table):
+    """create_all 不会修改已存在的表，这里补加新增的列（须可为空）和索引"""
+    with engine.begin() as conn:
+        existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                logger.info(f"已补加列: {table.name}.{column.name}")
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+
+def upgrade_schema():
+    """主库所有表补加新增的列和索引"""
+    for table in db.metadata.sorted_tables:
+        upgrade_table(db.engine, table)
+
 def init_database():
     """初始化数据库"""
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+        location_shards.engines()  # 分片模式下创建各分片库的位置表
         
         # 创建默认管理员
         admin = Admin.query.filter_by(username='admin').first()
@@ -566,9 +4270,14 @@ def init_database():
             for config in configs:
                 db.session.add(config)
         
+        if not SystemConfig.query.filter_by(config_key='device_offline_timeout').first():
+            db.session.add(SystemConfig(config_key='device_offline_timeout', config_value='300', description='设备离线超时(秒)'))
+        
+        config_cache.version.bump_on_commit(db.session)
         db.session.commit()
         logger.info("数据库初始化完成")
 
 if __name__ == '__main__':
     init_database()
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5000, debug=False) 
\ No newline at end of file
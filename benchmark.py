@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""GPS系统压测：生成模拟车队，测量上传与查询接口的吞吐、延迟和SQL语句数
+
+用法示例：
+    python benchmark.py --devices 1000 --rounds 5 --batch-size 20
+    python benchmark.py --mode gunicorn --workers 2 --json result.json
+    python benchmark.py --compare base.json --json result.json
+
+client 模式在本进程内用 Flask test client 调用，逐请求统计SQL语句数与耗时；
+gunicorn 模式启动本地 gunicorn 通过HTTP调用，更接近线上，SQL统计取自 /metrics。两种模式都使用临时数据库，
+GPS_INGEST_MODE、LOCATION_SHARDS 等环境变量照常生效。
+"""
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+EARTH_RADIUS = 6371000
+ENDPOINTS = ('upload', 'location', 'history', 'devices')
+ROUTES = {
+    'upload': '/api/gps/upload',
+    'location': '/api/devices/<device_id>/location',
+    'history': '/api/devices/<device_id>/history',
+    'devices': '/api/devices',
+}
+
+# ==================== 模拟车队 ====================
+
+class SimulatedVehicle:
+    """模拟车辆：行驶/停车交替，转向与变速平滑，上报位置叠加GPS噪声"""
+
+    def __init__(self, device_id, rng, origin, jitter, spike_rate):
+        self.device_id = device_id
+        self.rng = rng
+        self.jitter = jitter
+        self.spike_rate = spike_rate
+        self.lat = origin[0] + rng.uniform(-0.2, 0.2)
+        self.lng = origin[1] + rng.uniform(-0.2, 0.2)
+        self.heading = rng.uniform(0, 360)
+        self.speed = 0.0  # km/h
+        self.target_speed = rng.uniform(30, 80)
+        self.parked_seconds = rng.choice([0, 0, rng.uniform(60, 900)])
+
+    def step(self, dt):
+        """前进 dt 秒"""
+        rng = self.rng
+        if self.parked_seconds > 0:
+            self.parked_seconds -= dt
+            self.speed = 0.0
+            return
+
+        if rng.random() < 0.01:
+            # 到达目的地，停车1-15分钟
+            self.parked_seconds = rng.uniform(60, 900)
+            self.speed = 0.0
+            return
+        if rng.random() < 0.1:
+            self.target_speed = rng.uniform(20, 110)
+        self.speed += (self.target_speed - self.speed) * min(1.0, dt / 30)
+        self.heading = (self.heading + rng.gauss(0, 8 if self.speed > 40 else 20)) % 360
+
+        distance = self.speed / 3.6 * dt
+        self._move(distance, self.heading)
+
+    def _move(self, distance, heading):
+        angle = math.radians(heading)
+        self.lat += math.degrees(distance * math.cos(angle) / EARTH_RADIUS)
+        self.lng += math.degrees(distance * math.sin(angle) / (EARTH_RADIUS * math.cos(math.radians(self.lat))))
+
+    def report(self, timestamp):
+        """生成一条上报：停车时的漂移通常小于50米（应被防抖丢弃），偶发的跳点会超过阈值"""
+        rng = self.rng
+        noise = abs(rng.gauss(0, self.jitter))
+        if rng.random() < self.spike_rate:
+            noise = rng.uniform(50, 150)
+        angle = math.radians(rng.uniform(0, 360))
+        dlat = math.degrees(noise * math.cos(angle) / EARTH_RADIUS)
+        dlng = math.degrees(noise * math.sin(angle) / (EARTH_RADIUS * math.cos(math.radians(self.lat))))
+        return {
+            'latitude': round(self.lat + dlat, 6),
+            'longitude': round(self.lng + dlng, 6),
+            'altitude': round(50 + rng.gauss(0, 3), 1),
+            'accuracy': round(max(3.0, noise), 1),
+            'speed': round(max(0.0, self.speed + rng.gauss(0, 2)), 1) if self.speed else 0.0,
+            'heading': round(self.heading, 1),
+            'timestamp': timestamp.isoformat()
+        }
+
+class Fleet:
+    """模拟车队：按轮次为每辆车生成一批连续上报"""
+
+    def __init__(self, count, seed=1, interval=10, jitter=10.0, spike_rate=0.02, origin=(39.9, 116.4)):
+        self.rng = random.Random(seed)
+        self.interval = interval
+        self.vehicles = [
+            SimulatedVehicle(f'SIM{i:05d}', random.Random(seed * 100003 + i), origin, jitter, spike_rate)
+            for i in range(count)
+        ]
+
+    @property
+    def device_ids(self):
+        return [vehicle.device_id for vehicle in self.vehicles]
+
+    def batches(self, rounds, batch_size):
+        """依次产出 (device_id, locations)；时间从过去推进到当前"""
+        start = datetime.utcnow() - timedelta(seconds=rounds * batch_size * self.interval)
+        for r in range(rounds):
+            for vehicle in self.vehicles:
+                locations = []
+                for i in range(batch_size):
+                    vehicle.step(self.interval)
+                    timestamp = start + timedelta(seconds=(r * batch_size + i + 1) * self.interval)
+                    locations.append(vehicle.report(timestamp))
+                yield vehicle.device_id, locations
+
+# ==================== 被测应用 ====================
+
+def prepare_environment(workdir):
+    """导入应用前把数据库、分片与指标目录指向临时目录"""
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'gps_system.db')
+    os.environ['LOCATION_SHARD_DIR'] = workdir
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+
+def seed_database(device_ids):
+    """初始化临时数据库并登记模拟设备（部分设备关联车主和车型）"""
+    import app as gps_app
+
+    gps_app.init_database()
+    with gps_app.app.app_context():
+        db = gps_app.db
+        model_ids = [row.id for row in db.session.execute(db.select(gps_app.VehicleModel.id)).all()]
+        owners = [{'phone_number': f'138{i:08d}', 'owner_name': f'车主{i}'} for i in range(len(device_ids) // 2)]
+        if owners:
+            db.session.execute(gps_app.VehicleOwner.__table__.insert(), owners)
+        owner_ids = [row.id for row in db.session.execute(db.select(gps_app.VehicleOwner.id)).all()]
+
+        rows = []
+        for i, device_id in enumerate(device_ids):
+            rows.append({
+                'device_id': device_id,
+                'device_name': f'模拟车辆{i}',
+                'vehicle_plate': f'京A{i:05d}',
+                'owner_id': owner_ids[i] if i < len(owner_ids) else None,
+                'vehicle_model_id': model_ids[i % len(model_ids)] if model_ids else None,
+                'status': 'offline'
+            })
+        db.session.execute(gps_app.Device.__table__.insert(), rows)
+        db.session.commit()
+    return gps_app
+
+class SQLCounter:
+    """按线程统计SQL语句数与耗时（后台线程的语句不计入请求）"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        local = self._local
+        local.count = getattr(local, 'count', 0) + 1
+        local.seconds = getattr(local, 'seconds', 0.0) + time.perf_counter() - getattr(local, 'started', time.perf_counter())
+
+    def reset(self):
+        self._local.count = 0
+        self._local.seconds = 0.0
+
+    def read(self):
+        return getattr(self._local, 'count', 0), getattr(self._local, 'seconds', 0.0)
+
+class ClientTarget:
+    """进程内 test client"""
+
+    name = 'client'
+
+    def __init__(self, gps_app):
+        self.app = gps_app
+        self.sql = SQLCounter()
+        self.sql.install()
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.app.app.test_client()
+            with client.session_transaction() as session:
+                session['admin_id'] = 1
+                session['admin_username'] = 'admin'
+            self._local.client = client
+        return client
+
+    def request(self, method, path, body=None):
+        """返回 (状态码, 响应JSON或None, SQL语句数, SQL耗时秒)"""
+        client = self._client()
+        self.sql.reset()
+        if method == 'POST':
+            response = client.post(path, json=body)
+        else:
+            response = client.get(path)
+        count, seconds = self.sql.read()
+        data = response.get_json(silent=True)
+        response.close()
+        return response.status_code, data, count, seconds
+
+    def sql_totals(self, route):
+        # 逐请求统计，无需从 /metrics 汇总
+        return None
+
+    def wait_for_ingest(self, timeout=120):
+        """异步模式下等待写入队列清空，返回实际入库点数（同步模式返回None）"""
+        if self.app.app.config['GPS_INGEST_MODE'] != 'async':
+            return None
+        deadline = time.monotonic() + timeout
+        queue = self.app.ingest_queue
+        while time.monotonic() < deadline:
+            stats = queue.get_stats()
+            if stats['queue_depth'] == 0 and stats['committed_batches'] + stats['failed_batches'] > 0:
+                time.sleep(queue.max_wait * 2)
+                stats = queue.get_stats()
+                if stats['queue_depth'] == 0:
+                    return stats['accepted_points']
+            time.sleep(0.05)
+        return queue.get_stats()['accepted_points']
+
+    def close(self):
+        pass
+
+class HTTPTarget:
+    """本地 gunicorn 进程；SQL语句数按阶段从 /metrics 的计数差值计算"""
+
+    name = 'gunicorn'
+
+    def __init__(self, workdir, workers, threads):
+        gunicorn = shutil.which('gunicorn')
+        if not gunicorn:
+            raise SystemExit('未找到 gunicorn，请先 pip install gunicorn')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.base_url = f'http://127.0.0.1:{port}'
+        self.log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+        self.metrics_flush_interval = 0.5
+        env = dict(os.environ, METRICS_FLUSH_INTERVAL=str(self.metrics_flush_interval), METRICS_TOKEN='',
+                   WEB_THREADS=str(threads))
+        self.process = subprocess.Popen(
+            [gunicorn, '-w', str(workers), '--worker-class', 'gthread', '--threads', str(threads),
+             '-b', f'127.0.0.1:{port}', 'app:app'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=self.log, stderr=subprocess.STDOUT
+        )
+        self._wait_ready()
+        self._local = threading.local()
+        self._login()
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise SystemExit(f'gunicorn 启动失败，见 {self.log.name}')
+            try:
+                urllib.request.urlopen(self.base_url + '/login', timeout=5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise SystemExit('gunicorn 启动超时')
+
+    def _login(self):
+        """只登录一次，各线程共享会话Cookie（密码哈希校验很慢，不能算进被测请求）"""
+        self.cookies = http.cookiejar.CookieJar()
+        form = urllib.parse.urlencode({'username': 'admin', 'password': 'admin123'}).encode()
+        self._opener().open(self.base_url + '/login', data=form, timeout=30).close()
+
+    def _opener(self):
+        opener = getattr(self._local, 'opener', None)
+        if opener is None:
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+            self._local.opener = opener
+        return opener
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        try:
+            with self._opener().open(req, timeout=60) as response:
+                status, payload = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        try:
+            parsed = json.loads(payload)
+        except ValueError:
+            parsed = None
+        return status, parsed, None, None
+
+    def sql_totals(self, route):
+        """所有工作进程累计的 (请求数, SQL语句数, SQL秒数)"""
+        # 等其他工作进程写出最新快照
+        time.sleep(self.metrics_flush_interval * 2)
+        with urllib.request.urlopen(self.base_url + '/metrics', timeout=30) as response:
+            text = response.read().decode()
+        requests = statements = seconds = 0.0
+        for line in text.splitlines():
+            if line.startswith('#') or f'endpoint="{route}"' not in line:
+                continue
+            name, value = line.split('{', 1)[0], float(line.rsplit(' ', 1)[1])
+            if name == 'gps_http_requests_total':
+                requests += value
+            elif name == 'gps_sql_statements_total':
+                statements += value
+            elif name == 'gps_sql_seconds_total':
+                seconds += value
+        return requests, statements, seconds
+
+    def wait_for_ingest(self, timeout=120):
+        # 各工作进程的队列无法从外部汇总，留出一个合并周期；入库点数未知
+        if os.environ.get('GPS_INGEST_MODE') == 'async':
+            time.sleep(1)
+            return 0
+        return None
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+# ==================== 测量 ====================
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+class Recorder:
+    """收集单个接口的延迟与SQL统计"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statements = []
+        self.sql_seconds = []
+        self.errors = 0
+        self.points_sent = 0
+        self.points_accepted = 0
+        self.wall_seconds = 0.0
+        self.sql_totals = None  # 无逐请求统计时，由 /metrics 差值得到的 (请求数, 语句数, 秒数)
+        self._lock = threading.Lock()
+
+    def add(self, latency, status, statements, sql_seconds, points_sent=0, points_accepted=0):
+        with self._lock:
+            self.latencies.append(latency)
+            if status >= 400:
+                self.errors += 1
+            if statements is not None:
+                self.statements.append(statements)
+                self.sql_seconds.append(sql_seconds)
+            self.points_sent += points_sent
+            self.points_accepted += points_accepted
+
+    def summary(self):
+        count = len(self.latencies)
+        sql_per_request = sql_ms_per_request = None
+        if self.statements:
+            sql_per_request = round(sum(self.statements) / len(self.statements), 2)
+            sql_ms_per_request = round(sum(self.sql_seconds) / len(self.sql_seconds) * 1000, 2)
+        elif self.sql_totals and self.sql_totals[0]:
+            requests, statements, seconds = self.sql_totals
+            sql_per_request = round(statements / requests, 2)
+            sql_ms_per_request = round(seconds / requests * 1000, 2)
+        result = {
+            'requests': count,
+            'errors': self.errors,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'requests_per_sec': round(count / self.wall_seconds, 1) if self.wall_seconds else None,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2) if count else None,
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2) if count else None,
+            'mean_ms': round(sum(self.latencies) / count * 1000, 2) if count else None,
+            'sql_per_request': sql_per_request,
+            'sql_ms_per_request': sql_ms_per_request,
+        }
+        if self.points_sent:
+            result['points_sent'] = self.points_sent
+            result['points_accepted'] = self.points_accepted
+            result['points_per_sec'] = round(self.points_sent / self.wall_seconds, 1) if self.wall_seconds else None
+            result['debounced_ratio'] = round(1 - self.points_accepted / self.points_sent, 3) if self.points_accepted else None
+        return result
+
+def run_phase(target, recorder, jobs, concurrency, route):
+    """并发执行 jobs（每项为 (method, path, body, 点数)）并记录"""
+    def execute(job):
+        method, path, body, points = job
+        started = time.perf_counter()
+        status, data, statements, sql_seconds = target.request(method, path, body)
+        latency = time.perf_counter() - started
+        accepted = 0
+        if points and data:
+            accepted = data.get('accepted_count', data.get('queued_count', 0))
+        recorder.add(latency, status, statements, sql_seconds, points, accepted)
+
+    before = target.sql_totals(route)
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for job in jobs:
+            execute(job)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in pool.map(execute, jobs):
+                pass
+    recorder.wall_seconds = time.perf_counter() - started
+    if before is not None:
+        after = target.sql_totals(route)
+        recorder.sql_totals = tuple(a - b for a, b in zip(after, before))
+
+def run_benchmark(args, target, fleet):
+    rng = random.Random(args.seed)
+    results = {}
+    device_ids = fleet.device_ids
+
+    upload = Recorder()
+    jobs = (('POST', '/api/gps/upload', {'device_id': device_id, 'locations': locations}, len(locations))
+            for device_id, locations in fleet.batches(args.rounds, args.batch_size))
+    run_phase(target, upload, jobs, args.concurrency, ROUTES['upload'])
+    drain_started = time.perf_counter()
+    accepted = target.wait_for_ingest()
+    if accepted is not None:
+        # 异步模式的响应只有入队点数
+        upload.points_accepted = accepted
+    results['upload'] = upload.summary()
+    results['upload']['drain_seconds'] = round(time.perf_counter() - drain_started, 3)
+
+    location = Recorder()
+    run_phase(target, location, [
+        ('GET', f'/api/devices/{rng.choice(device_ids)}/location', None, 0) for _ in range(args.queries)
+    ], args.concurrency, ROUTES['location'])
+    results['location'] = location.summary()
+
+    history = Recorder()
+    history_query = f'?max_points={args.history_max_points}' if args.history_max_points else ''
+    run_phase(target, history, [
+        ('GET', f'/api/devices/{rng.choice(device_ids)}/history{history_query}', None, 0) for _ in range(args.queries)
+    ], args.concurrency, ROUTES['history'])
+    results['history'] = history.summary()
+
+    devices = Recorder()
+    run_phase(target, devices, [('GET', '/api/devices', None, 0) for _ in range(args.list_queries)],
+              args.concurrency, ROUTES['devices'])
+    results['devices'] = devices.summary()
+    return results
+
+# ==================== 报告 ====================
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_value(value):
+    return '-' if value is None else str(value)
+
+def print_report(report, baseline=None):
+    print(f"\n版本 {report['revision'] or '未知'} | 模式 {report['mode']} | 写入 {report['ingest_mode']} | "
+          f"分片 {report['location_shards']} | 设备 {report['params']['devices']} | 每批 {report['params']['batch_size']} 点")
+    columns = ('requests', 'errors', 'requests_per_sec', 'p50_ms', 'p99_ms', 'sql_per_request', 'sql_ms_per_request')
+    print(f"{'接口':<10}" + ''.join(f'{c:>20}' for c in columns))
+    for name in ENDPOINTS:
+        row = report['results'].get(name, {})
+        cells = []
+        for column in columns:
+            cell = format_value(row.get(column))
+            base = (baseline or {}).get('results', {}).get(name, {}).get(column)
+            if base and row.get(column) is not None and column not in ('requests', 'errors'):
+                cell += f' ({(row[column] - base) / base * 100:+.0f}%)'
+            cells.append(f'{cell:>20}')
+        print(f'{name:<10}' + ''.join(cells))
+
+    upload = report['results']['upload']
+    line = (f"\n上传: {upload.get('points_sent', 0)} 点, {format_value(upload.get('points_per_sec'))} 点/秒, "
+            f"防抖丢弃 {format_value(upload.get('debounced_ratio'))}, 队列排空 {upload['drain_seconds']} 秒")
+    base_upload = (baseline or {}).get('results', {}).get('upload', {})
+    if base_upload.get('points_per_sec') and upload.get('points_per_sec'):
+        line += f" | 对比基线 {baseline.get('revision') or '未知'}: " \
+                f"{(upload['points_per_sec'] - base_upload['points_per_sec']) / base_upload['points_per_sec'] * 100:+.0f}%"
+    print(line)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='GPS系统压测')
+    parser.add_argument('--mode', choices=('client', 'gunicorn'), default='client', help='进程内 test client 或本地 gunicorn')
+    parser.add_argument('--devices', type=int, default=200, help='模拟设备数')
+    parser.add_argument('--rounds', type=int, default=5, help='每台设备上传次数')
+    parser.add_argument('--batch-size', type=int, default=10, help='每次上传的点数')
+    parser.add_argument('--interval', type=int, default=10, help='相邻两点的时间间隔（秒）')
+    parser.add_argument('--jitter', type=float, default=10.0, help='GPS噪声标准差（米）')
+    parser.add_argument('--spike-rate', type=float, default=0.02, help='跳点比例（偏移50-150米）')
+    parser.add_argument('--queries', type=int, default=500, help='位置与轨迹查询次数')
+    parser.add_argument('--list-queries', type=int, default=20, help='设备列表查询次数')
+    parser.add_argument('--history-max-points', type=int, default=0, help='轨迹查询的 max_points 参数，0 表示不抽稀')
+    parser.add_argument('--concurrency', type=int, default=1, help='并发请求数')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn 工作进程数')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn 每进程线程数')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子，相同参数生成相同车队')
+    parser.add_argument('--json', help='结果写入JSON文件')
+    parser.add_argument('--compare', help='与之前保存的JSON结果对比')
+    parser.add_argument('--keep', action='store_true', help='保留临时数据库目录')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='gps-bench-')
+    prepare_environment(workdir)
+    fleet = Fleet(args.devices, seed=args.seed, interval=args.interval, jitter=args.jitter, spike_rate=args.spike_rate)
+
+    target = None
+    try:
+        gps_app = seed_database(fleet.device_ids)
+        if args.mode == 'client':
+            target = ClientTarget(gps_app)
+        else:
+            target = HTTPTarget(workdir, args.workers, args.threads)
+        results = run_benchmark(args, target, fleet)
+    finally:
+        if target:
+            target.close()
+        if args.keep:
+            print(f'临时目录: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.utcnow().isoformat(),
+        'mode': args.mode,
+        'ingest_mode': os.environ.get('GPS_INGEST_MODE', 'sync'),
+        'location_shards': int(os.environ.get('LOCATION_SHARDS', 1)),
+        'params': {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'keep')},
+        'results': results
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
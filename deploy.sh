@@ -140,6 +140,8 @@ cat > .env << EOF
 # GPS系统环境配置
 FLASK_ENV=production
 SECRET_KEY=gps-system-secret-key-$(date +%s)
+# 软件授权清单签名密钥（随机生成，勿与其他密钥共用）
+MANIFEST_SIGNING_KEY=$(openssl rand -hex 32)
 DATABASE_URL=sqlite:///gps_system.db
 
 # Redis配置
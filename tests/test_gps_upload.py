@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# app 在导入时读取配置，先把数据库和数据目录指向临时目录
+_tmpdir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmpdir, 'gps_system.db')
+os.environ['LOCATION_SHARD_DIR'] = _tmpdir
+os.environ['METRICS_DIR'] = os.path.join(_tmpdir, 'metrics')
+os.environ['GPS_INGEST_MODE'] = 'sync'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as gps_app
+from app import db, Device
+
+
+class UploadTimestampTest(unittest.TestCase):
+    """上传带时区的时间：统一换算为不带时区的UTC时间存储"""
+
+    @classmethod
+    def setUpClass(cls):
+        gps_app.init_database()
+        with gps_app.app.app_context():
+            db.session.add_all([Device(device_id=f'TZ{i}', status='offline') for i in range(3)])
+            db.session.commit()
+        cls.client = gps_app.app.test_client()
+
+    def upload(self, device_id, locations):
+        return self.client.post('/api/gps/upload', json={'device_id': device_id, 'locations': locations})
+
+    def test_utc_designator(self):
+        response = self.upload('TZ0', [{'latitude': 39.9, 'longitude': 116.4, 'timestamp': '2026-10-17T08:00:00Z'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['accepted_count'], 1)
+        location = self.client.get('/api/devices/TZ0/location').json
+        self.assertEqual(location['timestamp'], '2026-10-17T08:00:00')
+
+    def test_utc_offset(self):
+        response = self.upload('TZ1', [{'latitude': 39.9, 'longitude': 116.4, 'timestamp': '2026-10-17T16:00:00+08:00'}])
+        self.assertEqual(response.status_code, 200)
+        location = self.client.get('/api/devices/TZ1/location').json
+        self.assertEqual(location['timestamp'], '2026-10-17T08:00:00')
+
+    def test_mixed_batch_sorted_by_utc(self):
+        response = self.upload('TZ2', [
+            {'latitude': 39.90, 'longitude': 116.40, 'timestamp': '2026-10-17T16:02:00+08:00'},
+            {'latitude': 39.91, 'longitude': 116.40, 'timestamp': '2026-10-17T08:01:00'},
+            {'latitude': 39.92, 'longitude': 116.40, 'timestamp': '2026-10-17T08:00:00Z'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['accepted_count'], 3)
+        history = self.client.get('/api/devices/TZ2/history?start_date=2026-10-17T07:00:00Z&resolution=0').json
+        self.assertEqual(
+            [point['timestamp'] for point in history['history']],
+            ['2026-10-17T08:00:00', '2026-10-17T08:01:00', '2026-10-17T08:02:00']
+        )
+
+
+class UploadFormatTest(unittest.TestCase):
+    """格式错误的请求体：返回固定的错误说明，不带异常原文"""
+
+    @classmethod
+    def setUpClass(cls):
+        gps_app.init_database()
+        cls.client = gps_app.app.test_client()
+
+    def test_malformed_bodies(self):
+        for body in (b'{bad', b'[1, 2]', b'{"device_id": "TZ0", "locations": {"a": 1}}',
+                     b'{"device_id": {"a": 1}, "locations": [1]}'):
+            response = self.client.post('/api/gps/upload', data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(response.json['error'].startswith('数据格式错误'))
+            self.assertNotIn('object', response.json['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()